@@ -5,6 +5,7 @@ from typing import List, Dict, Any
 
 from app.db.base import SessionLocal
 from app.core.auth_dep import get_current_user
+from app.core.normalizacion import norm_lote
 
 router = APIRouter(prefix="/lotes", tags=["lotes"])
 # router = APIRouter(prefix="/scans", tags=["scans"])
@@ -14,13 +15,9 @@ class EnsureLoteIn(BaseModel):
     codigo: str
 
 
-def _norm(c: str) -> str:
-    return (c or "").strip().upper()
-
-
 @router.post("/ensure")
 def ensure_lote(payload: EnsureLoteIn, user=Depends(get_current_user)):
-    codigo = _norm(payload.codigo)
+    codigo = norm_lote(payload.codigo)
     if not codigo:
         raise HTTPException(400, "Código inválido")
 
@@ -65,7 +62,7 @@ def list_lotes(limit: int = 50, user=Depends(get_current_user)):
 
 @router.post("/{codigo}/close")
 def close_lote(codigo: str, user=Depends(get_current_user)):
-    c = _norm(codigo)
+    c = norm_lote(codigo)
 
     with SessionLocal() as db:
         r = db.execute(
@@ -99,7 +96,7 @@ def open_lote(codigo: str, user=Depends(get_current_user)):
     if (user.get("rol") or "").upper() != "ROOT":
         raise HTTPException(403, "Solo ROOT puede reabrir")
 
-    c = _norm(codigo)
+    c = norm_lote(codigo)
 
     with SessionLocal() as db:
         r = db.execute(
@@ -1,16 +1,17 @@
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Depends, Header
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy import select
 
 from app.core.session import get_usuario
-from app.core.tokens import generar_token
-from app.services.qr_service import generar_qr_memoria
-from app.services.zpl_service import generar_zpl_qr
-from app.services.agent_client import enviar_job_agente
-from app.services.zpl_service import generar_zpl_qr_4cols
-from app.core.security import sign  # si necesitas firmar aquí (si ya firmas en otro lado, usa tu flujo)
+from app.core.normalizacion import norm_dni
+from app.services.qr_service import preview_cacheado, generar_hoja_contactos_pdf
+from app.services.ticket_service import emitir_tickets
+from app.services import print_run_service
 
 from app.db.base import SessionLocal
-from app.db.models import QREmitido
+from app.db.models import PrintRun, PrintRunRow
 from app.config import IMPRESORA_ACTIVA
 
 router = APIRouter(tags=["QR"])
@@ -18,40 +19,75 @@ router = APIRouter(tags=["QR"])
 # ==========================================================
 # GENERAR QR (PNG) – NO IMPRIME
 # ==========================================================
+def _preview_response(dni: str, nn: str, producto: str, if_none_match: Optional[str]) -> Response:
+    # Token SOLO para vista previa (no se guarda) -> imagen cacheable por (dni, nn, producto)
+    png, etag = preview_cacheado(dni, nn, producto)
+
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if if_none_match:
+        etags = [t.strip() for t in if_none_match.split(",")]
+        if etag in etags or "*" in etags:
+            return Response(status_code=304, headers=headers)
+
+    return Response(content=png, media_type="image/png", headers=headers)
+
+
 @router.post("/preview")
-def preview_qr(data: dict):
+def preview_qr(data: dict, if_none_match: Optional[str] = Header(None)):
     required = ["dni", "nn", "producto"]
     if not all(k in data for k in required):
         raise HTTPException(400, "Datos incompletos")
 
-    # Token SOLO para vista previa (no se guarda)
-    token_preview = "VP"
+    return _preview_response(str(data["dni"]), str(data["nn"]), str(data["producto"]), if_none_match)
 
-    img = generar_qr_memoria(
-        token_preview,
-        data["dni"],
-        data["nn"],
-        data["producto"]
-    )
 
-    return StreamingResponse(img, media_type="image/png")
+@router.get("/preview")
+def preview_qr_get(
+    dni: str,
+    nn: str,
+    producto: str,
+    if_none_match: Optional[str] = Header(None),
+):
+    return _preview_response(dni, nn, producto, if_none_match)
 
 
 # ==========================================================
-# IMPRIMIR QR (ZPL) – USA PRINT AGENT (COLA)
+# IMPRIMIR QR (ZPL) – CORRIDA ASÍNCRONA VÍA PRINT AGENT (COLA)
 # ==========================================================
+def _entero(valor, campo: str, minimo: int, maximo: int) -> int:
+    """
+    Entero del body en [minimo, maximo]; 400 si no lo es.
+    """
+    error = HTTPException(400, f"{campo} debe ser un entero entre {minimo} y {maximo}")
+    if isinstance(valor, bool):
+        raise error
+    try:
+        n = int(valor)
+    except (TypeError, ValueError):
+        raise error
+    if (isinstance(valor, float) and valor != n) or not minimo <= n <= maximo:
+        raise error
+    return n
+
+
 @router.post("/print")
 def print_tickets(
     data: dict,
     usuario: str = Depends(get_usuario)
 ):
+    """
+    Emite los tickets y registra una corrida de impresión.
+    Responde de inmediato con run_id; un worker envía las filas al agente.
+    Progreso: GET /qr/runs/{run_id}
+    """
     required = ["dni", "nn", "producto", "cantidad"]
     if not all(k in data for k in required):
         raise HTTPException(400, "Datos incompletos")
 
-    cantidad = int(data["cantidad"])
-    if cantidad < 1 or cantidad > 5000:
-        raise HTTPException(400, "Cantidad fuera de rango")
+    dni = norm_dni(data["dni"])
+
+    cantidad = _entero(data["cantidad"], "cantidad", 1, 5000)
 
     # Dinámico desde UI (opcional)
     agent_url = data.get("agent_url")  # ej: http://200.100.20.153:5000
@@ -64,66 +100,147 @@ def print_tickets(
     # agent_id solo se usa si NO mandas agent_url
     agent_id = IMPRESORA_ACTIVA.get("agent_id")
 
-    tickets = []
+    # Stock de etiquetas (columnas por fila); default 4
+    validas = print_run_service.COLUMNAS_VALIDAS
+    columnas = data.get("columnas")
+    columnas = print_run_service.COLUMNAS_DEFAULT if columnas is None else _entero(columnas, "columnas", min(validas), max(validas))
+    if columnas not in validas:
+        raise HTTPException(400, f"columnas debe ser uno de {list(validas)}")
+
+    # Filas ZPL por job del agente (opcional; default PRINT_ROWS_PER_JOB)
+    filas_por_job = data.get("filas_por_job")
+    if filas_por_job is not None:
+        filas_por_job = _entero(filas_por_job, "filas_por_job", 1, print_run_service.MAX_ROWS_PER_JOB)
+
+    # Formato almacenado ^DF/^XF (opcional; default PRINT_STORED_FORMATS)
+    formato_almacenado = data.get("formato_almacenado")
+    if formato_almacenado is not None:
+        formato_almacenado = bool(formato_almacenado)
 
     with SessionLocal() as db:
-        remaining = cantidad
-
-        while remaining > 0:
-            batch_n = 4 if remaining >= 4 else remaining
-            batch_items = []
-
-            # 1) Generar y guardar 1..4 tickets
-            for _ in range(batch_n):
-                token = generar_token(data["producto"])
-
-                qr = QREmitido(
-                    token=token,
-                    dni_trabajador=data["dni"],
-                    nn=data["nn"],
-                    producto=data["producto"],
-                    impreso_por=usuario
-                )
-                db.add(qr)
-                db.flush()
-
-                base = f"{token}|{data['dni']}|{data['nn']}|{data['producto']}|1"
-                sig = sign(base)
-
-                batch_items.append({
-                    "token": token,
-                    "dni": data["dni"],
-                    "visible": data["nn"],
-                    "producto": data["producto"],
-                    "sig": sig,
-                })
-
-            # 2) ZPL 4 columnas (una fila)
-            zpl = generar_zpl_qr_4cols(batch_items, dpi=203, qr_mag=4)
-
-            # 3) Enviar 1 job por fila (4 columnas) usando dinámico si viene
-            job = enviar_job_agente(
-                agent_url=agent_url,
-                agent_id=None if agent_url else agent_id,
-                printer=printer,
-                raw=zpl,
-                copies=1
-            )
-
-            job_id = job.get("job_id") or job.get("id")
-
-            for it in batch_items:
-                tickets.append({"token": it["token"], "job_id": job_id})
-
-            remaining -= batch_n
+        # 1) Generar y guardar TODOS los tickets (1 INSERT multi-fila)
+        items = emitir_tickets(
+            db,
+            dni=dni,
+            nn=data["nn"],
+            producto=data["producto"],
+            usuario=usuario,
+            cantidad=cantidad,
+        )
+
+        # 2) Registrar la corrida (filas de `columnas` etiquetas)
+        run_id = print_run_service.crear_corrida(
+            db,
+            items=items,
+            dni=dni,
+            nn=data["nn"],
+            producto=data["producto"],
+            printer=printer,
+            agent_url=agent_url,
+            agent_id=None if agent_url else agent_id,
+            usuario=usuario,
+            filas_por_job=filas_por_job,
+            columnas=columnas,
+            formato_almacenado=formato_almacenado,
+        )
 
         db.commit()
 
+    # 3) El envío al agente ocurre en segundo plano
+    print_run_service.encolar(run_id)
+
     return {
         "ok": True,
+        "run_id": run_id,
+        "estado": "PENDIENTE",
         "cantidad": cantidad,
-        "tickets": tickets,
+        "tickets": [{"token": it["token"], "job_id": None} for it in items],
         "printer": printer,
         "agent_url": agent_url
     }
 
+
+# ==========================================================
+# CORRIDAS DE IMPRESIÓN – PROGRESO / FILAS / REINTENTO
+# ==========================================================
+@router.get("/runs/{run_id}")
+def get_run(run_id: str):
+    with SessionLocal() as db:
+        run = db.get(PrintRun, run_id)
+        if not run:
+            raise HTTPException(404, "Corrida no existe")
+        return print_run_service.resumen_corrida(run)
+
+
+@router.get("/runs/{run_id}/rows")
+def get_run_rows(run_id: str, estado: Optional[str] = None):
+    with SessionLocal() as db:
+        if not db.get(PrintRun, run_id):
+            raise HTTPException(404, "Corrida no existe")
+
+        q = select(PrintRunRow).where(PrintRunRow.run_id == run_id)
+        if estado:
+            q = q.where(PrintRunRow.estado == estado.strip().upper())
+
+        filas = db.execute(q.order_by(PrintRunRow.fila)).scalars().all()
+
+        return {
+            "run_id": run_id,
+            "items": [
+                {
+                    "fila": f.fila,
+                    "tokens": f.tokens,
+                    "estado": f.estado,
+                    "job_id": f.job_id,
+                    "intentos": f.intentos,
+                    "error": f.error,
+                    "actualizado_en": f.actualizado_en,
+                }
+                for f in filas
+            ],
+        }
+
+
+@router.get("/runs/{run_id}/proof")
+def get_run_proof(run_id: str):
+    """
+    Hoja de contactos PDF con todos los tickets de la corrida (prueba de impresión).
+    """
+    with SessionLocal() as db:
+        run = db.get(PrintRun, run_id)
+        if not run:
+            raise HTTPException(404, "Corrida no existe")
+
+        filas = db.execute(
+            select(PrintRunRow.tokens)
+            .where(PrintRunRow.run_id == run_id)
+            .order_by(PrintRunRow.fila)
+        ).scalars().all()
+
+        tickets = [
+            (token, run.dni_trabajador, run.nn, run.producto)
+            for tokens in filas
+            for token in tokens
+        ]
+
+    pdf = generar_hoja_contactos_pdf(tickets)
+
+    return StreamingResponse(
+        pdf,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f'inline; filename="corrida_{run_id[:8]}.pdf"'},
+    )
+
+
+@router.post("/runs/{run_id}/retry")
+def retry_run(run_id: str):
+    with SessionLocal() as db:
+        if not db.get(PrintRun, run_id):
+            raise HTTPException(404, "Corrida no existe")
+        n = print_run_service.reintentar_fallidas(db, run_id)
+        db.commit()
+
+    if n:
+        print_run_service.encolar(run_id)
+
+    return {"run_id": run_id, "filas_reencoladas": n}
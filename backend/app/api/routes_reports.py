@@ -1,10 +1,17 @@
+import os
+import re
+
 from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from sqlalchemy import text
 from datetime import datetime, timezone
 from typing import Optional, Tuple
 
 from app.db.base import SessionLocal
 from app.core.auth_dep import get_current_user
+from app.core.normalizacion import norm_lote
+from app.services import export_service
 
 router = APIRouter(prefix="/reports", tags=["reports"])
 
@@ -61,14 +68,15 @@ def _resolve_lote(db, lote_codigo: Optional[str]) -> Tuple[Optional[int], Option
     Si lote_codigo viene, valida que exista y retorna (lote_id, codigo, estado).
     Si no viene, retorna (None, None, None) (sin filtro por lote).
     """
-    codigo = _clean_optional(lote_codigo)
+    codigo = norm_lote(lote_codigo)
     if not codigo:
         return None, None, None
 
+    # lotes.codigo se guarda normalizado (norm_lote): comparación directa, usa el índice
     q = text("""
         SELECT id, codigo, estado
         FROM lotes
-        WHERE TRIM(UPPER(codigo)) = TRIM(UPPER(:codigo))
+        WHERE codigo = :codigo
         LIMIT 1;
     """)
     row = db.execute(q, {"codigo": codigo}).mappings().first()
@@ -79,6 +87,66 @@ def _resolve_lote(db, lote_codigo: Optional[str]) -> Tuple[Optional[int], Option
     return int(row["id"]), row.get("codigo"), row.get("estado")
 
 
+# -------------------------
+# Consultas (las usan el JSON y los /export)
+# -------------------------
+# Lee de scan_rollup (conteos ya agregados por la ingesta), no de scan_events
+_DNI_TOTALS_SQL = text("""
+SELECT
+  COALESCE(SUM(r.con_id), 0)::int AS total_lecturas,
+  COALESCE(SUM(r.con_id) FILTER (WHERE r.kind = 'EMPACADOR'), 0)::int AS emp_lecturas,
+  COALESCE(SUM(r.con_id) FILTER (WHERE r.kind = 'SELECCIONADOR'), 0)::int AS sel_lecturas
+FROM scan_rollup r
+WHERE (:producto IS NULL OR r.producto = :producto)
+  AND (:scanned_by IS NULL OR r.user_id = :scanned_by)
+  AND (:lote_id IS NULL OR r.lote_id = :lote_id)
+;
+""")
+
+_DNI_ROWS_SQL = text("""
+SELECT
+  r.dni,
+  COALESCE(
+    NULLIF(
+      TRIM(
+        t.apellido_paterno || ' ' ||
+        COALESCE(t.apellido_materno, '') || ' ' ||
+        COALESCE(t.nombre, '')
+      ),
+      ''
+    ),
+    'SIN REGISTRO'
+  ) AS persona,
+  (COALESCE(SUM(r.con_id) FILTER (WHERE r.kind = 'EMPACADOR'), 0))::int AS empacador,
+  (COALESCE(SUM(r.con_id) FILTER (WHERE r.kind = 'SELECCIONADOR'), 0))::int AS seleccionador,
+  SUM(r.con_id)::int AS total
+FROM scan_rollup r
+LEFT JOIN trabajadores t
+  ON t.dni = r.dni
+ AND t.activo = true
+WHERE r.con_id > 0
+  AND (:producto IS NULL OR r.producto = :producto)
+  AND (:scanned_by IS NULL OR r.user_id = :scanned_by)
+  AND (:lote_id IS NULL OR r.lote_id = :lote_id)
+GROUP BY r.dni, persona
+ORDER BY total DESC;
+""")
+
+_OPERATOR_SQL = text("""
+SELECT
+  NULLIF(r.user_id, '') AS user_id,
+  SUM(r.total)::int AS total,
+  COUNT(DISTINCT r.dni)::int AS dnis_distintos,
+  MAX(r.ultima_lectura) AS ultima_lectura
+FROM scan_rollup r
+WHERE (:producto IS NULL OR r.producto = :producto)
+  AND (:scanned_by IS NULL OR r.user_id = :scanned_by)
+  AND (:lote_id IS NULL OR r.lote_id = :lote_id)
+GROUP BY r.user_id
+ORDER BY total DESC, ultima_lectura DESC;
+""")
+
+
 # -------------------------
 # Reporte: DNI Summary (totales + tabla por DNI) - POR LOTE
 # -------------------------
@@ -93,52 +161,6 @@ def dni_summary(
     scanned_by_eff = _effective_user_filter(user, scanned_by)
     lote_codigo = _clean_optional(lote_codigo)
 
-    totals_sql = text("""
-    SELECT
-      COUNT(*) AS total_lecturas,
-      COUNT(*) FILTER (WHERE (se.raw->>'id') ~ '^[0-9]+$') AS emp_lecturas,
-      COUNT(*) FILTER (WHERE (se.raw->>'id') ~ '^[A-Za-z]+$') AS sel_lecturas
-    FROM scan_events se
-    LEFT JOIN lotes l ON l.id = se.lote_id
-    WHERE se.raw IS NOT NULL
-      AND (se.raw->>'id') IS NOT NULL
-      AND (:producto IS NULL OR se.raw->>'p' = :producto)
-      AND (:scanned_by IS NULL OR se.user_id = :scanned_by)
-      AND (:lote_id IS NULL OR se.lote_id = :lote_id)
-    ;
-    """)
-
-    rows_sql = text("""
-    SELECT
-      se.dni,
-      COALESCE(
-        NULLIF(
-          TRIM(
-            t.apellido_paterno || ' ' ||
-            COALESCE(t.apellido_materno, '') || ' ' ||
-            COALESCE(t.nombre, '')
-          ),
-          ''
-        ),
-        'SIN REGISTRO'
-      ) AS persona,
-      COUNT(*) FILTER (WHERE (se.raw->>'id') ~ '^[0-9]+$') AS empacador,
-      COUNT(*) FILTER (WHERE (se.raw->>'id') ~ '^[A-Za-z]+$') AS seleccionador,
-      COUNT(*) AS total
-    FROM scan_events se
-    LEFT JOIN lotes l ON l.id = se.lote_id
-    LEFT JOIN trabajadores t
-      ON TRIM(t.dni) = TRIM(se.dni)
-     AND t.activo = true
-    WHERE se.raw IS NOT NULL
-      AND (se.raw->>'id') IS NOT NULL
-      AND (:producto IS NULL OR se.raw->>'p' = :producto)
-      AND (:scanned_by IS NULL OR se.user_id = :scanned_by)
-      AND (:lote_id IS NULL OR se.lote_id = :lote_id)
-    GROUP BY se.dni, persona
-    ORDER BY total DESC;
-    """)
-
     with SessionLocal() as db:
         lote_id, _, _ = _resolve_lote(db, lote_codigo)
 
@@ -148,8 +170,8 @@ def dni_summary(
             "lote_id": lote_id,
         }
 
-        totals = db.execute(totals_sql, params).mappings().first() or {}
-        rows = db.execute(rows_sql, params).mappings().all()
+        totals = db.execute(_DNI_TOTALS_SQL, params).mappings().first() or {}
+        rows = db.execute(_DNI_ROWS_SQL, params).mappings().all()
 
     return {
         "producto": producto,
@@ -175,24 +197,9 @@ def operator_summary(
     scanned_by_eff = _effective_user_filter(user, scanned_by)
     lote_codigo = _clean_optional(lote_codigo)
 
-    sql = text("""
-    SELECT
-      se.user_id,
-      COUNT(*)::int AS total,
-      COUNT(DISTINCT se.dni)::int AS dnis_distintos,
-      MAX(se.scanned_at) AS ultima_lectura
-    FROM scan_events se
-    LEFT JOIN lotes l ON l.id = se.lote_id
-    WHERE (:producto IS NULL OR se.raw->>'p' = :producto)
-      AND (:scanned_by IS NULL OR se.user_id = :scanned_by)
-      AND (:lote_id IS NULL OR se.lote_id = :lote_id)
-    GROUP BY se.user_id
-    ORDER BY total DESC, ultima_lectura DESC;
-    """)
-
     with SessionLocal() as db:
         lote_id, _, _ = _resolve_lote(db, lote_codigo)
-        rows = db.execute(sql, {
+        rows = db.execute(_OPERATOR_SQL, {
             "producto": producto,
             "scanned_by": scanned_by_eff,
             "lote_id": lote_id,
@@ -205,3 +212,124 @@ def operator_summary(
         "rows": [dict(r) for r in rows],
     }
 
+
+
+# -------------------------
+# Exportación (CSV / XLSX) - streaming
+# -------------------------
+_SCANS_EXPORT_SQL = text("""
+SELECT
+  se.token,
+  se.dni,
+  se.producto,
+  se.visible_id,
+  se.kind,
+  se.user_id,
+  se.device_id,
+  se.scanned_at,
+  se.sig_ok,
+  se.batch_uuid,
+  se.session_uuid
+FROM scan_events se
+WHERE se.lote_id = :lote_id
+  AND (:producto IS NULL OR se.producto = :producto)
+  AND (:scanned_by IS NULL OR se.user_id = :scanned_by)
+ORDER BY se.scanned_at, se.token;
+""")
+
+_EXPORT_MEDIA = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+def _nombre_archivo(texto: str) -> str:
+    # va dentro de Content-Disposition: nada de comillas, ; ni saltos de línea
+    return re.sub(r"[^A-Za-z0-9_-]", "_", texto)
+
+
+def _export(sql, params: dict, nombre: str, lote_codigo: Optional[str], formato: str):
+    """
+    CSV: se envía mientras se lee la consulta.
+    XLSX: el libro se arma completo en un archivo temporal y recién después se envía.
+    """
+    formato = (formato or "csv").strip().lower()
+    if formato not in _EXPORT_MEDIA:
+        raise HTTPException(400, "format debe ser csv o xlsx")
+
+    archivo = f"{_nombre_archivo(nombre)}_{_nombre_archivo(lote_codigo or 'todos')}.{formato}"
+    headers = {"Content-Disposition": f'attachment; filename="{archivo}"'}
+    filas = export_service.filas_consulta(sql, params)
+
+    if formato == "csv":
+        return StreamingResponse(export_service.csv_stream(filas), media_type=_EXPORT_MEDIA["csv"], headers=headers)
+
+    try:
+        ruta = export_service.xlsx_archivo(filas, hoja=nombre)
+    except ImportError:
+        raise HTTPException(400, "Exportar a XLSX requiere xlsxwriter en el servidor")
+
+    return FileResponse(
+        ruta,
+        media_type=_EXPORT_MEDIA["xlsx"],
+        headers=headers,
+        background=BackgroundTask(os.unlink, ruta),
+    )
+
+
+def _export_params(user, producto, scanned_by, lote_codigo, lote_requerido: bool = False):
+    producto = _clean_optional(producto)
+    scanned_by_eff = _effective_user_filter(user, scanned_by)
+    lote_codigo = _clean_optional(lote_codigo)
+
+    if lote_requerido and not lote_codigo:
+        raise HTTPException(400, "Falta lote_codigo")
+
+    with SessionLocal() as db:
+        lote_id, codigo, _ = _resolve_lote(db, lote_codigo)
+
+    params = {
+        "producto": producto,
+        "scanned_by": scanned_by_eff,
+        "lote_id": lote_id,
+    }
+    return params, codigo
+
+
+@router.get("/dni-summary/export")
+def dni_summary_export(
+    producto: Optional[str] = Query(None),
+    scanned_by: Optional[str] = Query(None),
+    lote_codigo: Optional[str] = Query(None),
+    format: str = Query("csv", description="csv | xlsx"),
+    user=Depends(get_current_user),
+):
+    params, codigo = _export_params(user, producto, scanned_by, lote_codigo)
+    return _export(_DNI_ROWS_SQL, params, "dni_summary", codigo, format)
+
+
+@router.get("/operator-summary/export")
+def operator_summary_export(
+    producto: Optional[str] = Query(None),
+    scanned_by: Optional[str] = Query(None),
+    lote_codigo: Optional[str] = Query(None),
+    format: str = Query("csv", description="csv | xlsx"),
+    user=Depends(get_current_user),
+):
+    params, codigo = _export_params(user, producto, scanned_by, lote_codigo)
+    return _export(_OPERATOR_SQL, params, "operator_summary", codigo, format)
+
+
+@router.get("/scans/export")
+def scans_export(
+    lote_codigo: str = Query(..., description="Código de lote"),
+    producto: Optional[str] = Query(None),
+    scanned_by: Optional[str] = Query(None),
+    format: str = Query("csv", description="csv | xlsx"),
+    user=Depends(get_current_user),
+):
+    """
+    Todos los scans del lote (una fila por lectura).
+    """
+    params, codigo = _export_params(user, producto, scanned_by, lote_codigo, lote_requerido=True)
+    return _export(_SCANS_EXPORT_SQL, params, "scans", codigo, format)
@@ -1,12 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException
+import zlib
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from sqlalchemy import text
 from datetime import datetime
-import json
 
 from app.db.base import SessionLocal
 from app.core.auth_dep import get_current_user
+from app.core.normalizacion import norm_lote
+from app.services import scan_index, scan_service
 
 router = APIRouter(prefix="/scans", tags=["scans"])
 
@@ -30,8 +34,37 @@ class BatchIn(BaseModel):
     scans: List[ScanItem]
 
 
-def _norm_lote(c: str) -> str:
-    return (c or "").strip().upper()
+class ExistsIn(BaseModel):
+    tokens: List[str]
+
+
+MAX_EXISTS_TOKENS = 5000
+
+
+def _lote_abierto(db, lote_codigo: str, usuario: Optional[str]):
+    """
+    Resuelve (o crea ABIERTO) el lote. 409 si está CERRADO.
+    """
+    lote_row = db.execute(
+        text("SELECT id, estado FROM lotes WHERE codigo = :c"),
+        {"c": lote_codigo},
+    ).fetchone()
+
+    if lote_row is None:
+        lote_row = db.execute(
+            text("""
+                INSERT INTO lotes (codigo, estado, creado_por)
+                VALUES (:c, 'ABIERTO', :u)
+                RETURNING id, estado
+            """),
+            {"c": lote_codigo, "u": usuario},
+        ).fetchone()
+        db.commit()
+
+    if lote_row.estado == "CERRADO":
+        raise HTTPException(409, f"Lote {lote_codigo} está CERRADO")
+
+    return lote_row
 
 
 # =========================
@@ -44,16 +77,50 @@ def token_exists(token: str, user=Depends(get_current_user)):
         raise HTTPException(400, "Token inválido")
 
     with SessionLocal() as db:
-        r = db.execute(
-            text("SELECT 1 FROM scan_events WHERE token = :t LIMIT 1"),
-            {"t": t}
-        ).fetchone()
+        existe = t in scan_index.existentes(db, [t])
+
+    return {"token": t, "exists": existe}
+
+
+@router.post("/exists")
+def tokens_exist(payload: ExistsIn, user=Depends(get_current_user)):
+    tokens = list(dict.fromkeys(t.strip() for t in payload.tokens if t and t.strip()))
+    if len(tokens) > MAX_EXISTS_TOKENS:
+        raise HTTPException(400, f"Máximo {MAX_EXISTS_TOKENS} tokens por consulta")
 
-    return {"token": t, "exists": r is not None}
+    # El índice reparte: los "quizás" se buscan por token, los descartados solo entre las filas nuevas
+    with SessionLocal() as db:
+        existentes = scan_index.existentes(db, tokens)
+
+    return {
+        "count": len(tokens),
+        "existing_count": len(existentes),
+        "results": {t: t in existentes for t in tokens},
+    }
+
+
+def _respuesta_batch(batch_uuid: str, res: Dict[str, Any], include_duplicates: bool, replayed: bool = False):
+    out = {
+        "batch_uuid": batch_uuid,
+        "accepted_count": res["accepted_count"],
+        "duplicate_count": res["duplicate_count"],
+        "invalid_sig_count": res.get("invalid_sig_count", 0),
+        "rejected_count": res.get("rejected_count", 0),
+    }
+    if replayed:
+        out["replayed"] = True
+    if include_duplicates:
+        out["duplicates"] = res["duplicates"]
+    return out
 
 
 @router.post("/batch")
-def upload_batch(payload: BatchIn, user=Depends(get_current_user)):
+def upload_batch(
+    payload: BatchIn,
+    include_duplicates: bool = Query(False, description="Incluir la lista de tokens duplicados"),
+    reject_invalid_sig: Optional[bool] = Query(None, description="Rechazar scans con firma inválida (default: SCAN_REJECT_BAD_SIG)"),
+    user=Depends(get_current_user),
+):
     if payload.scans is None:
         raise HTTPException(400, "Falta scans")
 
@@ -64,101 +131,309 @@ def upload_batch(payload: BatchIn, user=Depends(get_current_user)):
             "duplicate_count": 0
         }
 
-    lote_codigo = _norm_lote(payload.lote_codigo)
+    lote_codigo = norm_lote(payload.lote_codigo)
     if not lote_codigo:
         raise HTTPException(400, "Falta lote_codigo")
 
-    insert_sql = text("""
-        INSERT INTO scan_events (
-            token,
-            dni,
-            user_id,
-            device_id,
-            scanned_at,
-            batch_uuid,
-            session_uuid,
-            raw,
-            lote_id
+    with SessionLocal() as db:
+        # 0) Reintento de un batch ya procesado: responder desde scan_batches
+        previo = scan_service.batch_procesado(db, payload.batch_uuid)
+        if previo is not None:
+            return _respuesta_batch(payload.batch_uuid, previo, include_duplicates, replayed=True)
+
+        # 1) Resolver / crear lote
+        lote_row = _lote_abierto(db, lote_codigo, user.get("usuario"))
+
+        # 2) Registrar el batch (si otro request lo tomó primero, responder con su resultado)
+        if not scan_service.reservar_batch(
+            db,
+            payload.batch_uuid,
+            lote_id=lote_row.id,
+            user_id=user["usuario"],
+            device_id=payload.device_id,
+        ):
+            db.rollback()
+            previo = scan_service.batch_procesado(db, payload.batch_uuid)
+            if previo is None:
+                raise HTTPException(409, f"batch_uuid {payload.batch_uuid} es un upload por stream sin terminar")
+            return _respuesta_batch(payload.batch_uuid, previo, include_duplicates, replayed=True)
+
+        # 3) Insertar scans (un solo statement para todo el lote)
+        filas = scan_service.preparar_filas(payload.scans, payload.shift_label)
+        filas, invalidas, rechazados = scan_service.filtrar_firmas(filas, reject_invalid_sig)
+        aceptados = scan_service.insertar_scans(
+            db,
+            filas,
+            lote_id=lote_row.id,
+            user_id=user["usuario"],
+            device_id=payload.device_id,
+            batch_uuid=payload.batch_uuid,
+            session_uuid=payload.session_uuid,
         )
-        VALUES (
-            :token,
-            :dni,
-            :user_id,
-            :device_id,
-            :scanned_at,
-            :batch_uuid,
-            :session_uuid,
-            CAST(:raw AS jsonb),
-            :lote_id
+        res = scan_service.cerrar_batch(
+            db,
+            payload.batch_uuid,
+            scan_count=len(payload.scans),
+            aceptados=len(aceptados),
+            dups=scan_service.duplicados(filas, aceptados),
+            firmas_invalidas=invalidas,
+            rechazados=rechazados,
         )
-        ON CONFLICT (token) DO NOTHING
-        RETURNING token
-    """)
+        db.commit()
+
+    scan_service.recordar_batch(payload.batch_uuid, res)
+    return _respuesta_batch(payload.batch_uuid, res, include_duplicates)
 
-    accepted = 0
 
+# =========================
+# UPLOAD POR STREAM (NDJSON, opcionalmente gzip)
+# =========================
+STREAM_MAX_LINEA = 64 * 1024            # bytes por registro NDJSON
+STREAM_MAX_INFLADO = 1024 * 1024        # bytes descomprimidos por paso
+
+
+def _abrir_stream(batch_uuid: str, lote_codigo: str, usuario: str, device_id: Optional[str]):
+    """
+    (lote_id, resultado previo si ya terminó, avance ya confirmado si se retoma).
+    """
     with SessionLocal() as db:
-        # 1) Resolver / crear lote
-        lote_row = db.execute(
-            text("SELECT id, estado FROM lotes WHERE codigo = :c"),
-            {"c": lote_codigo},
-        ).fetchone()
+        previo = scan_service.batch_procesado(db, batch_uuid)
+        if previo is not None:
+            return None, previo, None
 
-        if lote_row is None:
-            lote_row = db.execute(
-                text("""
-                    INSERT INTO lotes (codigo, estado, creado_por)
-                    VALUES (:c, 'ABIERTO', :u)
-                    RETURNING id, estado
-                """),
-                {"c": lote_codigo, "u": user.get("usuario")},
-            ).fetchone()
-            db.commit()
+        lote_id = _lote_abierto(db, lote_codigo, usuario).id
+        avance = scan_service.tomar_stream(db, batch_uuid, lote_id=lote_id, user_id=usuario, device_id=device_id)
+        if avance is None:
+            db.rollback()
+            previo = scan_service.batch_procesado(db, batch_uuid)
+            if previo is not None:
+                return None, previo, None
+            raise HTTPException(409, f"Upload {batch_uuid} ya está en curso")
+        db.commit()
+        return lote_id, None, avance
 
-        if lote_row.estado == "CERRADO":
-            raise HTTPException(409, f"Lote {lote_codigo} está CERRADO")
 
-        lote_id = lote_row.id
+def _flush_stream(filas: List[Dict[str, Any]], avance: Dict[str, Any], **meta) -> int:
+    """
+    Inserta un chunk y guarda el avance del upload en la misma transacción.
+    """
+    with SessionLocal() as db:
+        aceptados = scan_service.insertar_scans(db, filas, **meta) if filas else []
+        avance["accepted_count"] += len(aceptados)
+        scan_service.avance_stream(db, meta["batch_uuid"], **avance)
+        db.commit()
+    return len(aceptados)
 
-        # 2) Insertar scans
-        for s in payload.scans:
-            token = (s.token or "").strip()
-            dni = (s.dni or "").strip()
 
-            if not token or not dni:
-                continue
+def _fallar_stream(batch_uuid: str, error: str) -> None:
+    with SessionLocal() as db:
+        scan_service.fallar_stream(db, batch_uuid, error)
 
-            raw_dict = s.raw or {}
 
-            # Guardar shift_label dentro del raw (no altera esquema)
-            if payload.shift_label:
-                raw_dict.setdefault("shift_label", payload.shift_label)
+def _cerrar_stream(batch_uuid: str, avance: Dict[str, Any]) -> Dict[str, Any]:
+    with SessionLocal() as db:
+        res = scan_service.cerrar_batch(
+            db,
+            batch_uuid,
+            scan_count=avance["scan_count"],
+            aceptados=avance["accepted_count"],
+            dups=None,
+            firmas_invalidas=avance["invalid_sig_count"],
+            rechazados=avance["rejected_count"],
+        )
+        scan_service.avance_stream(db, batch_uuid, lineas=avance["lineas"], chunks=avance["chunks"])
+        db.commit()
+    scan_service.recordar_batch(batch_uuid, res)
+    return res
+
 
-            raw_json = json.dumps(raw_dict) if raw_dict else None
+def _lineas(buffer: bytearray, fin: bool = False):
+    """
+    Extrae las líneas completas de buffer (lo deja con el resto).
+    """
+    while True:
+        i = buffer.find(b"\n")
+        if i < 0:
+            break
+        linea = bytes(buffer[:i])
+        del buffer[:i + 1]
+        yield linea
 
-            r = db.execute(
-                insert_sql,
-                {
-                    "token": token,
-                    "dni": dni,
-                    "user_id": user["usuario"],
-                    "device_id": payload.device_id,
-                    "scanned_at": s.scanned_at,
-                    "batch_uuid": payload.batch_uuid,
-                    "session_uuid": payload.session_uuid,
-                    "raw": raw_json,
-                    "lote_id": lote_id,
-                }
-            ).fetchone()
+    if len(buffer) > STREAM_MAX_LINEA:
+        raise HTTPException(400, "Registro NDJSON demasiado largo")
 
-            if r is not None:
-                accepted += 1
+    if fin and buffer:
+        linea = bytes(buffer)
+        buffer.clear()
+        yield linea
 
-        db.commit()
 
-    duplicates = len(payload.scans) - accepted
-    return {
-        "batch_uuid": payload.batch_uuid,
-        "accepted_count": accepted,
-        "duplicate_count": duplicates
+@router.post("/stream")
+async def upload_stream(
+    request: Request,
+    batch_uuid: str = Query(...),
+    lote_codigo: str = Query(...),
+    session_uuid: Optional[str] = Query(None),
+    device_id: Optional[str] = Query(None),
+    shift_label: Optional[str] = Query(None),
+    reject_invalid_sig: Optional[bool] = Query(None),
+    user=Depends(get_current_user),
+):
+    """
+    Upload de backlogs grandes: cuerpo NDJSON (un ScanItem por línea), gzip o plano.
+    Se procesa a medida que llega y se inserta cada SCAN_STREAM_CHUNK_ROWS filas,
+    con memoria acotada. Progreso: GET /scans/stream/{batch_uuid}.
+
+    Cada chunk se confirma junto con el avance en scan_batches. Si el upload se corta,
+    reenviar el mismo cuerpo con el mismo batch_uuid: se saltan las líneas ya confirmadas
+    y los conteos de la respuesta son del upload completo.
+    """
+    lote_codigo = norm_lote(lote_codigo)
+    if not lote_codigo:
+        raise HTTPException(400, "Falta lote_codigo")
+
+    lote_id, previo, avance = await run_in_threadpool(
+        _abrir_stream, batch_uuid, lote_codigo, user["usuario"], device_id
+    )
+    if previo is not None:
+        return _respuesta_batch(batch_uuid, previo, False, replayed=True)
+
+    meta = {
+        "lote_id": lote_id,
+        "user_id": user["usuario"],
+        "device_id": device_id,
+        "batch_uuid": batch_uuid,
+        "session_uuid": session_uuid,
     }
+
+    inflador = None           # zlib, si el cuerpo viene en gzip (se detecta por los primeros bytes)
+    buffer = bytearray()
+    scans: List[ScanItem] = []
+    saltar = avance["lineas"]  # líneas ya confirmadas por un intento anterior
+    lineas = 0                 # líneas de este cuerpo
+    pendiente = {"scan_count": 0, "invalid_sig_count": 0, "rejected_count": 0}
+
+    async def flush():
+        nonlocal scans
+        filas = scan_service.preparar_filas(scans, shift_label)
+        scans = []
+        filas, inv, rech = scan_service.filtrar_firmas(filas, reject_invalid_sig)
+        nuevo = dict(
+            avance,
+            lineas=lineas,
+            scan_count=avance["scan_count"] + pendiente["scan_count"],
+            invalid_sig_count=avance["invalid_sig_count"] + inv,
+            rejected_count=avance["rejected_count"] + rech,
+            chunks=avance["chunks"] + 1,
+        )
+        await run_in_threadpool(_flush_stream, filas, nuevo, **meta)
+        avance.update(nuevo)   # solo lo confirmado
+        pendiente["scan_count"] = 0
+
+    async def consumir(fin: bool = False):
+        nonlocal lineas
+        for linea in _lineas(buffer, fin):
+            lineas += 1
+            if lineas <= saltar or not linea.strip():
+                continue
+            try:
+                scans.append(ScanItem.model_validate_json(linea))
+            except ValueError as e:
+                raise HTTPException(400, f"Línea {lineas} inválida: {e}")
+            pendiente["scan_count"] += 1
+            if len(scans) >= scan_service.STREAM_CHUNK_ROWS:
+                await flush()
+
+    try:
+        async for parte in request.stream():
+            if not parte:
+                continue
+            if inflador is None:
+                inflador = zlib.decompressobj(16 + zlib.MAX_WBITS) if parte[:2] == b"\x1f\x8b" else False
+
+            if inflador:
+                datos = inflador.decompress(parte, STREAM_MAX_INFLADO)
+                while True:
+                    buffer.extend(datos)
+                    await consumir()
+                    if not inflador.unconsumed_tail:
+                        break
+                    datos = inflador.decompress(inflador.unconsumed_tail, STREAM_MAX_INFLADO)
+            else:
+                buffer.extend(parte)
+                await consumir()
+
+        if inflador:
+            buffer.extend(inflador.flush())
+        await consumir(fin=True)
+        if scans:
+            await flush()
+        avance["lineas"] = max(avance["lineas"], lineas)
+
+        res = await run_in_threadpool(_cerrar_stream, batch_uuid, avance)
+    except zlib.error as e:
+        await run_in_threadpool(_fallar_stream, batch_uuid, f"gzip inválido: {e}")
+        raise HTTPException(400, f"gzip inválido: {e}")
+    except HTTPException as e:
+        await run_in_threadpool(_fallar_stream, batch_uuid, str(e.detail))
+        raise
+    except Exception as e:
+        await run_in_threadpool(_fallar_stream, batch_uuid, str(e) or type(e).__name__)
+        raise
+
+    out = _respuesta_batch(batch_uuid, res, False)
+    out["lines"] = avance["lineas"]
+    out["chunks"] = avance["chunks"]
+    if saltar:
+        out["resumed_from_line"] = saltar
+    return out
+
+
+@router.get("/stream/{batch_uuid}")
+def upload_stream_progress(batch_uuid: str, user=Depends(get_current_user)):
+    with SessionLocal() as db:
+        p = scan_service.progreso_stream(db, batch_uuid)
+    if p is None:
+        raise HTTPException(404, "Upload no encontrado")
+    return {"batch_uuid": batch_uuid, **p}
+
+
+# =========================
+# SYNC OFFLINE POR LOTE
+# =========================
+@router.get("/sync/{lote_codigo}")
+def sync_lote(
+    lote_codigo: str,
+    since: int = Query(0, ge=0, description="Versión ya descargada (0 = snapshot completo)"),
+    user=Depends(get_current_user),
+):
+    """
+    Tokens ya escaneados del lote para chequear duplicados sin red:
+    cuerpo = hashes uint64 big-endian ordenados (ver scan_service.hash_token).
+    Guardar X-Sync-Version y pedir luego ?since=<versión> para la delta.
+    """
+    c = norm_lote(lote_codigo)
+
+    with SessionLocal() as db:
+        lote = db.execute(
+            text("SELECT id FROM lotes WHERE codigo = :c"),
+            {"c": c},
+        ).fetchone()
+        if lote is None:
+            raise HTTPException(404, "Lote no existe")
+
+        snap = scan_service.sync_lote(db, lote.id, since)
+
+    return Response(
+        content=snap["data"],
+        media_type="application/octet-stream",
+        headers={
+            "X-Sync-Lote": c,
+            "X-Sync-Kind": "delta" if since else "snapshot",
+            "X-Sync-Since": str(since),
+            "X-Sync-Version": str(snap["version"]),
+            "X-Sync-Count": str(snap["count"]),
+            "X-Sync-Hash": scan_service.SYNC_HASH,
+            "Cache-Control": "no-store",
+        },
+    )
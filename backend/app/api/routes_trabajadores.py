@@ -5,6 +5,7 @@ from sqlalchemy.exc import IntegrityError
 from app.db.base import SessionLocal
 from app.core.assignments import next_num_orden, next_cod_letra
 from app.core.auth_dep import get_current_user 
+from app.core.normalizacion import norm_dni
 
 router = APIRouter()
 
@@ -51,7 +52,7 @@ def crear_trabajador(data: dict, user: dict = Depends(get_current_user)):
     if rol_user not in ("ROOT", "SUPERVISOR"):
         raise HTTPException(status_code=403, detail="Permiso insuficiente")
 
-    dni = (data.get("dni") or "").strip()
+    dni = norm_dni(data.get("dni"))
     nombre = (data.get("nombre") or data.get("nombres") or "").strip()
     apellido_paterno = (data.get("apellido_paterno") or data.get("ap_paterno") or "").strip()
     apellido_materno = (data.get("apellido_materno") or data.get("ap_materno") or "").strip()
@@ -114,7 +115,7 @@ def actualizar_trabajador(trabajador_id: int, data: dict, user: dict = Depends(g
     if (user.get("rol") or "").upper() not in ("ROOT", "SUPERVISOR"):
         raise HTTPException(status_code=403, detail="Permiso insuficiente")
 
-    dni = (data.get("dni") or "").strip()
+    dni = norm_dni(data.get("dni"))
     nombre = (data.get("nombre") or "").strip()
     apellido_paterno = (data.get("apellido_paterno") or "").strip()
     apellido_materno = (data.get("apellido_materno") or "").strip()
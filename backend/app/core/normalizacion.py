@@ -0,0 +1,18 @@
+import re
+
+# Claves que se comparan/juntan en la BD: se guardan ya normalizadas (sin TRIM/UPPER en las consultas)
+_ESPACIOS = re.compile(r"\s+")
+
+
+def norm_dni(dni) -> str:
+    """
+    DNI sin espacios (ni al borde ni en medio): "  1234 5678 " -> "12345678".
+    """
+    return _ESPACIOS.sub("", str(dni or ""))
+
+
+def norm_lote(codigo) -> str:
+    """
+    Código de lote sin espacios al borde y en mayúsculas: " 1234-2026a " -> "1234-2026A".
+    """
+    return str(codigo or "").strip().upper()
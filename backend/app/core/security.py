@@ -1,10 +1,87 @@
-import hmac, hashlib, base64
+import hmac, hashlib, base64, json
+from typing import Iterable, List, Optional, Tuple
 from app.config import SECRET_KEY
 
 # 16 bytes = 128 bits (~22 chars en base64url sin '=')
 SIG_BYTES = 16
 
-def sign(payload: str) -> str:
-    mac = hmac.new(SECRET_KEY, payload.encode("utf-8"), hashlib.sha256).digest()
+# Versión del payload del QR (campo "v")
+PAYLOAD_V = 1
+
+# Estado HMAC ya inicializado con la clave: cada firma parte de un .copy()
+_MAC_BASE = hmac.new(SECRET_KEY, digestmod=hashlib.sha256)
+
+# (token, dni, visible, producto)
+Ticket = Tuple[str, str, str, str]
+
+
+def _b64(mac: bytes) -> str:
     mac = mac[:SIG_BYTES]  # <-- truncado
     return base64.urlsafe_b64encode(mac).decode("ascii").rstrip("=")
+
+
+def sign(payload: str) -> str:
+    mac = _MAC_BASE.copy()
+    mac.update(payload.encode("utf-8"))
+    return _b64(mac.digest())
+
+
+def base_firma(token: str, dni: str, visible: str, producto: str) -> str:
+    """
+    Texto canónico que se firma: token|dni|visible|producto|v
+    """
+    return f"{token}|{dni}|{visible}|{producto}|{PAYLOAD_V}"
+
+
+def firmar_lote(tickets: Iterable[Ticket]) -> List[str]:
+    """
+    Firma muchos tickets reutilizando el estado HMAC pre-cargado con la clave.
+    """
+    copiar = _MAC_BASE.copy
+    firmas = []
+    for t in tickets:
+        mac = copiar()
+        mac.update(base_firma(*t).encode("utf-8"))
+        firmas.append(_b64(mac.digest()))
+    return firmas
+
+
+def verificar_lote(payloads: Iterable[Optional[dict]]) -> List[Optional[bool]]:
+    """
+    Verifica en lote payloads de QR ya decodificados ({t, dni, id, p, v, sig}).
+    True/False por payload; None si no trae firma (nada que verificar).
+    """
+    copiar = _MAC_BASE.copy
+    out: List[Optional[bool]] = []
+    for p in payloads:
+        sig = p.get("sig") if p else None
+        if not sig:
+            out.append(None)
+            continue
+        if str(p.get("v")) != str(PAYLOAD_V):
+            out.append(False)
+            continue
+        mac = copiar()
+        mac.update(base_firma(p.get("t", ""), p.get("dni", ""), p.get("id", ""), p.get("p", "")).encode("utf-8"))
+        # bytes: compare_digest rechaza str no ASCII (firma adulterada -> False, no excepción)
+        out.append(hmac.compare_digest(_b64(mac.digest()).encode(), str(sig).encode("utf-8", "surrogatepass")))
+    return out
+
+
+def payload_qr(token: str, dni: str, visible: str, producto: str, sig: Optional[str] = None) -> str:
+    """
+    JSON canónico que va dentro del QR (compacto, UTF-8).
+    Si no se pasa sig, se firma aquí.
+    """
+    if sig is None:
+        sig = sign(base_firma(token, dni, visible, producto))
+
+    payload = {
+        "t": token,
+        "dni": dni,
+        "id": visible,
+        "p": producto,
+        "v": PAYLOAD_V,
+        "sig": sig,
+    }
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
@@ -1,4 +1,94 @@
 import secrets
+import threading
+from typing import List
+
+from sqlalchemy import text
+
+# Secuencia de tokens: cada nextval reserva un bloque de TOKEN_BLOCK_SIZE números
+TOKEN_SEQ = "qr_token_seq"
+TOKEN_BLOCK_SIZE = 1000
+
+_MASK40 = (1 << 40) - 1
+
+# Base32 Crockford: 8 caracteres = 40 bits (sin I, L, O, U)
+_B32 = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+
 
 def generar_token(prefijo: str) -> str:
+    """
+    Token aleatorio legado (XX- + 8 hex). Sin garantía de unicidad.
+    """
     return f"{prefijo[:2].upper()}-{secrets.token_hex(4).upper()}"
+
+
+def _mezclar(n: int) -> int:
+    """
+    Permutación biyectiva de 40 bits: números consecutivos -> tokens no consecutivos,
+    sin colisiones (multiplicación por impar y xorshift son invertibles mod 2^40).
+    """
+    n &= _MASK40
+    n = (n * 0x9E3779B97F) & _MASK40
+    n ^= n >> 19
+    n = (n * 0xC2B2AE3D27) & _MASK40
+    n ^= n >> 21
+    return n
+
+
+def token_desde_numero(prefijo: str, n: int) -> str:
+    """
+    XX_ + 8 caracteres base32 (40 bits): mismo largo que el token legado, así el
+    payload del QR no crece. El separador "_" evita colisiones con los legados (XX-).
+    """
+    v = _mezclar(n)
+    cuerpo = "".join(_B32[(v >> shift) & 31] for shift in range(35, -1, -5))
+    return f"{prefijo[:2].upper()}_{cuerpo}"
+
+
+class AsignadorTokens:
+    """
+    Reparte números únicos en memoria a partir de bloques reservados en la
+    secuencia TOKEN_SEQ (INCREMENT BY TOKEN_BLOCK_SIZE).
+
+    Un bloque se reserva con un solo nextval; N bloques con un solo SELECT.
+    Los números de un bloque no usado se pierden (huecos), nunca se repiten.
+    """
+
+    def __init__(self, bloque: int = TOKEN_BLOCK_SIZE):
+        self.bloque = bloque
+        self._lock = threading.Lock()
+        self._siguiente = 0
+        self._fin = 0
+
+    def _reservar_bloques(self, db, k: int) -> List[int]:
+        rows = db.execute(
+            text(f"SELECT nextval('{TOKEN_SEQ}') FROM generate_series(1, :k)"),
+            {"k": k},
+        ).scalars().all()
+        return sorted(rows)
+
+    def reservar(self, db, cantidad: int) -> List[int]:
+        with self._lock:
+            numeros = list(range(self._siguiente, min(self._fin, self._siguiente + cantidad)))
+            self._siguiente += len(numeros)
+
+            faltan = cantidad - len(numeros)
+            if faltan > 0:
+                k = -(-faltan // self.bloque)  # ceil
+                for inicio in self._reservar_bloques(db, k):
+                    toma = min(faltan, self.bloque)
+                    numeros.extend(range(inicio, inicio + toma))
+                    faltan -= toma
+                    # el resto del último bloque queda para la próxima corrida
+                    self._siguiente, self._fin = inicio + toma, inicio + self.bloque
+
+            return numeros
+
+
+_asignador = AsignadorTokens()
+
+
+def reservar_tokens(db, prefijo: str, cantidad: int) -> List[str]:
+    """
+    `cantidad` tokens únicos sin consultar qr_emitidos (ni reintentos por PK).
+    """
+    return [token_desde_numero(prefijo, n) for n in _asignador.reservar(db, cantidad)]
@@ -2,6 +2,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from app.config import DATABASE_URL
 from app.db.models import Base
+from app.db.migrations import aplicar_migraciones
 
 
 engine = create_engine(DATABASE_URL, future=True)
@@ -9,3 +10,4 @@ SessionLocal = sessionmaker(bind=engine, autoflush=False)
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    aplicar_migraciones(engine)
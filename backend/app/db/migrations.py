@@ -0,0 +1,192 @@
+import logging
+from typing import List, Tuple
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# Agregación de scan_events en scan_rollup (también la usa la ingesta, ver scan_service)
+ROLLUP_COLUMNAS = "(lote_id, dni, producto, user_id, kind, total, con_id, ultima_lectura)"
+ROLLUP_SELECT = """
+    SELECT
+        COALESCE(lote_id, 0),
+        COALESCE(dni, ''),
+        COALESCE(producto, ''),
+        COALESCE(user_id, ''),
+        COALESCE(kind, ''),
+        COUNT(*),
+        COUNT(visible_id),
+        MAX(scanned_at)
+    FROM {origen}
+    GROUP BY 1, 2, 3, 4, 5
+    ORDER BY 1, 2, 3, 4, 5
+"""
+
+# norm_dni en SQL: sin espacios (ni al borde ni en medio)
+_NORM_DNI = r"regexp_replace({col}, '\s', '', 'g')"
+
+# Normaliza una clave (dni, codigo) en su tabla sin chocar con valores únicos:
+# si la versión limpia ya existe, la fila sucia no se toca; si varias filas sucias
+# se limpian al mismo valor (' 123' y '123 '), solo se actualiza la primera (ctid)
+# y las demás quedan como están.
+_LIMPIAR_CLAVE = """
+    UPDATE {tabla} t
+    SET {col} = d.limpio
+    FROM (
+        SELECT fila, limpio, row_number() OVER (PARTITION BY limpio ORDER BY fila) AS n
+        FROM (SELECT ctid AS fila, {col} AS valor, {norm} AS limpio FROM {tabla}) x
+        WHERE valor <> limpio
+    ) d
+    WHERE t.ctid = d.fila
+      AND d.n = 1
+      AND NOT EXISTS (SELECT 1 FROM {tabla} o WHERE o.{col} = d.limpio)
+"""
+
+# Cambios de esquema sobre tablas que no son del ORM (scan_events, lotes, trabajadores).
+# Cada migración se aplica una sola vez (registro en schema_migrations) y en orden.
+# Nunca editar una migración ya publicada: agregar una nueva al final.
+MIGRACIONES: List[Tuple[str, List[str]]] = [
+    # 0001/0002 agregaban scan_events.ingest_seq (BIGSERIAL: reescribe toda la tabla).
+    # Reemplazada por ingest_xid (0007); quedan vacías y 0010 la borra donde ya se aplicó.
+    ("0001_scan_events_ingest_seq", []),
+    ("0002_scan_events_lote_seq", []),
+    (
+        "0003_scan_events_sig_ok",
+        [
+            # Firma HMAC del payload verificada al ingresar (NULL = sin payload / previo)
+            "ALTER TABLE scan_events ADD COLUMN IF NOT EXISTS sig_ok BOOLEAN",
+            "CREATE INDEX IF NOT EXISTS ix_scan_events_sig_invalida ON scan_events (lote_id) WHERE sig_ok = false",
+            "ALTER TABLE scan_batches ADD COLUMN IF NOT EXISTS invalid_sig_count INTEGER DEFAULT 0",
+            "ALTER TABLE scan_batches ADD COLUMN IF NOT EXISTS rejected_count INTEGER DEFAULT 0",
+        ],
+    ),
+    (
+        "0004_scan_events_columnas_tipadas",
+        [
+            # Campos del payload que usan los reportes, como columnas (antes: raw->>'p' / regex sobre raw->>'id')
+            "ALTER TABLE scan_events ADD COLUMN IF NOT EXISTS producto TEXT",
+            "ALTER TABLE scan_events ADD COLUMN IF NOT EXISTS visible_id TEXT",
+            "ALTER TABLE scan_events ADD COLUMN IF NOT EXISTS kind VARCHAR(16)",
+            """
+            UPDATE scan_events
+            SET producto = raw->>'p',
+                visible_id = raw->>'id',
+                kind = CASE
+                    WHEN (raw->>'id') ~ '^[0-9]+$' THEN 'EMPACADOR'
+                    WHEN (raw->>'id') ~ '^[A-Za-z]+$' THEN 'SELECCIONADOR'
+                END
+            WHERE raw IS NOT NULL
+              AND producto IS NULL
+              AND visible_id IS NULL
+            """,
+            "CREATE INDEX IF NOT EXISTS ix_scan_events_lote_prod_kind ON scan_events (lote_id, producto, kind)",
+            "CREATE INDEX IF NOT EXISTS ix_scan_events_prod_kind ON scan_events (producto, kind)",
+        ],
+    ),
+    (
+        "0005_scan_rollup_backfill",
+        [
+            # scan_rollup (ORM) la crea create_all vacía; se carga una vez con lo existente
+            f"INSERT INTO scan_rollup {ROLLUP_COLUMNAS} {ROLLUP_SELECT.format(origen='scan_events')}",
+            "CREATE INDEX IF NOT EXISTS ix_scan_rollup_user ON scan_rollup (user_id, lote_id)",
+            "CREATE INDEX IF NOT EXISTS ix_scan_rollup_producto ON scan_rollup (producto, lote_id)",
+        ],
+    ),
+    (
+        "0006_normalizar_dni_lote",
+        [
+            # Mismo criterio que core.normalizacion (norm_dni / norm_lote).
+            _LIMPIAR_CLAVE.format(tabla="trabajadores", col="dni", norm=_NORM_DNI.format(col="dni")),
+            _LIMPIAR_CLAVE.format(tabla="lotes", col="codigo", norm="UPPER(TRIM(codigo))"),
+            f"UPDATE scan_events SET dni = {_NORM_DNI.format(col='dni')} WHERE dni <> {_NORM_DNI.format(col='dni')}",
+            f"UPDATE qr_emitidos SET dni_trabajador = {_NORM_DNI.format(col='dni_trabajador')} "
+            f"WHERE dni_trabajador <> {_NORM_DNI.format(col='dni_trabajador')}",
+            # scan_rollup se rearma con los DNI ya limpios
+            "DELETE FROM scan_rollup",
+            f"INSERT INTO scan_rollup {ROLLUP_COLUMNAS} {ROLLUP_SELECT.format(origen='scan_events')}",
+            # Joins/búsquedas por igualdad directa
+            "CREATE INDEX IF NOT EXISTS ix_trabajadores_dni_activo ON trabajadores (dni) WHERE activo = true",
+            "CREATE INDEX IF NOT EXISTS ix_lotes_codigo ON lotes (codigo)",
+            "CREATE INDEX IF NOT EXISTS ix_scan_events_dni ON scan_events (dni)",
+            "CREATE INDEX IF NOT EXISTS ix_scan_rollup_dni ON scan_rollup (dni)",
+        ],
+    ),
+    (
+        "0007_scan_events_ingest_xid",
+        [
+            # txid de la transacción que insertó: lecturas incrementales seguras (ver scan_index.marca_confirmada).
+            # Una secuencia no sirve de cursor: una transacción lenta confirma filas con seq por debajo de lo ya leído.
+            # Filas previas quedan en NULL: solo entran en cargas completas.
+            "ALTER TABLE scan_events ADD COLUMN IF NOT EXISTS ingest_xid BIGINT",
+            "ALTER TABLE scan_events ALTER COLUMN ingest_xid SET DEFAULT txid_current()",
+            "CREATE INDEX IF NOT EXISTS ix_scan_events_ingest_xid ON scan_events (ingest_xid)",
+        ],
+    ),
+    (
+        "0008_scan_events_lote_xid",
+        [
+            # Deltas de /scans/sync por lote
+            "CREATE INDEX IF NOT EXISTS ix_scan_events_lote_xid ON scan_events (lote_id, ingest_xid)",
+        ],
+    ),
+    (
+        "0009_scan_batches_avance_stream",
+        [
+            # Avance de uploads por stream, confirmado junto con cada chunk
+            "ALTER TABLE scan_batches ADD COLUMN IF NOT EXISTS estado VARCHAR(16)",
+            "ALTER TABLE scan_batches ADD COLUMN IF NOT EXISTS lineas INTEGER DEFAULT 0",
+            "ALTER TABLE scan_batches ADD COLUMN IF NOT EXISTS chunks INTEGER DEFAULT 0",
+            "ALTER TABLE scan_batches ADD COLUMN IF NOT EXISTS error VARCHAR",
+            "ALTER TABLE scan_batches ADD COLUMN IF NOT EXISTS actualizado_en TIMESTAMP",
+            "UPDATE scan_batches SET estado = 'COMPLETADO' WHERE estado IS NULL AND terminado_en IS NOT NULL",
+        ],
+    ),
+    (
+        "0010_scan_events_sin_ingest_seq",
+        [
+            # Ver 0001: ya nada la usa (DROP COLUMN no reescribe la tabla; borra también la secuencia)
+            "DROP INDEX IF EXISTS ix_scan_events_lote_seq",
+            "DROP INDEX IF EXISTS ix_scan_events_ingest_seq",
+            "ALTER TABLE scan_events DROP COLUMN IF EXISTS ingest_seq",
+        ],
+    ),
+]
+
+# Clave de pg_advisory_lock: un solo proceso migra a la vez
+_LOCK_KEY = 0x51525052
+
+
+def aplicar_migraciones(engine) -> None:
+    """
+    Cada migración en su propia transacción: los bloqueos de una no se suman a los
+    de las demás, y si una falla las anteriores quedan aplicadas.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+
+    with engine.connect() as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": _LOCK_KEY})
+        try:
+            conn.execute(text("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    id TEXT PRIMARY KEY,
+                    aplicada_en TIMESTAMPTZ NOT NULL DEFAULT NOW()
+                )
+            """))
+            conn.commit()
+
+            hechas = set(conn.execute(text("SELECT id FROM schema_migrations")).scalars())
+            conn.commit()
+
+            for mid, sentencias in MIGRACIONES:
+                if mid in hechas:
+                    continue
+                logger.info("Aplicando migración %s", mid)
+                for sql in sentencias:
+                    conn.execute(text(sql))
+                conn.execute(text("INSERT INTO schema_migrations (id) VALUES (:id)"), {"id": mid})
+                conn.commit()
+        finally:
+            conn.rollback()
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": _LOCK_KEY})
+            conn.commit()
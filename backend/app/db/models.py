@@ -1,7 +1,9 @@
 from sqlalchemy.orm import DeclarativeBase, mapped_column
-from sqlalchemy import String, Boolean, DateTime, Integer
+from sqlalchemy import String, Boolean, DateTime, Integer, JSON, ForeignKey, Index, Sequence
 from datetime import datetime
 
+from app.core.tokens import TOKEN_SEQ, TOKEN_BLOCK_SIZE
+
 class Base(DeclarativeBase):
     pass
 
@@ -15,6 +17,10 @@ class Usuario(Base):
     creado_en = mapped_column(DateTime, default=datetime.utcnow)
 
 
+# Bloques de tokens (ver core.tokens.AsignadorTokens): cada nextval reserva TOKEN_BLOCK_SIZE
+qr_token_seq = Sequence(TOKEN_SEQ, start=1, increment=TOKEN_BLOCK_SIZE, metadata=Base.metadata)
+
+
 class QREmitido(Base):
     __tablename__ = "qr_emitidos"
     token = mapped_column(String, primary_key=True)
@@ -38,3 +44,98 @@ class Impresora(Base):
     activa = mapped_column(Boolean, default=True)
     creado_en = mapped_column(DateTime, default=datetime.utcnow)
 
+
+class PrintRun(Base):
+    """
+    Corrida de impresión asíncrona (/qr/print).
+    Los tickets ya están emitidos; un worker envía las filas al Print Agent.
+    """
+    __tablename__ = "print_runs"
+
+    id = mapped_column(String(32), primary_key=True)           # uuid4 hex
+    dni_trabajador = mapped_column(String(8))
+    nn = mapped_column(String(3))
+    producto = mapped_column(String)
+    cantidad = mapped_column(Integer, nullable=False)
+    printer = mapped_column(String, nullable=False)
+    agent_url = mapped_column(String, nullable=True)
+    agent_id = mapped_column(String, nullable=True)
+    columnas = mapped_column(Integer, default=4)                # etiquetas por fila (stock de 1..4 columnas)
+    filas_por_job = mapped_column(Integer, default=1)           # filas ZPL combinadas en cada job del agente
+    formato_almacenado = mapped_column(Boolean, default=False)  # ^DF/^XF: la impresora guarda el layout
+    estado = mapped_column(String(20), default="PENDIENTE")     # PENDIENTE | EN_PROCESO | COMPLETADO | CON_ERRORES
+    filas_total = mapped_column(Integer, default=0)
+    filas_enviadas = mapped_column(Integer, default=0)
+    filas_fallidas = mapped_column(Integer, default=0)
+    ultimo_error = mapped_column(String, nullable=True)
+    creado_por = mapped_column(String)
+    creado_en = mapped_column(DateTime, default=datetime.utcnow)
+    actualizado_en = mapped_column(DateTime, default=datetime.utcnow)
+    terminado_en = mapped_column(DateTime, nullable=True)
+
+
+class PrintRunRow(Base):
+    """
+    Una fila de etiquetas (PrintRun.columnas) dentro de una corrida.
+    Varias filas pueden compartir el mismo job_id (ver PrintRun.filas_por_job).
+    """
+    __tablename__ = "print_run_rows"
+    __table_args__ = (
+        Index("ix_print_run_rows_run_fila", "run_id", "fila", unique=True),
+    )
+
+    id = mapped_column(Integer, primary_key=True, autoincrement=True)
+    run_id = mapped_column(String(32), ForeignKey("print_runs.id", ondelete="CASCADE"), nullable=False)
+    fila = mapped_column(Integer, nullable=False)
+    tokens = mapped_column(JSON, nullable=False)
+    estado = mapped_column(String(20), default="PENDIENTE")     # PENDIENTE | ENVIADA | FALLIDA
+    job_id = mapped_column(String, nullable=True)
+    intentos = mapped_column(Integer, default=0)
+    error = mapped_column(String, nullable=True)
+    actualizado_en = mapped_column(DateTime, default=datetime.utcnow)
+
+
+class ScanRollup(Base):
+    """
+    Conteos de scan_events acumulados por (lote, dni, producto, operador, kind).
+    Lo mantiene la ingesta (scan_service.insertar_scans) en el mismo statement del INSERT;
+    los reportes leen de aquí. Claves sin valor se guardan como 0 / "".
+    """
+    __tablename__ = "scan_rollup"
+
+    lote_id = mapped_column(Integer, primary_key=True, default=0)
+    dni = mapped_column(String, primary_key=True)
+    producto = mapped_column(String, primary_key=True, default="")
+    user_id = mapped_column(String, primary_key=True, default="")
+    kind = mapped_column(String(16), primary_key=True, default="")   # EMPACADOR | SELECCIONADOR | ""
+    total = mapped_column(Integer, nullable=False, default=0)         # todos los scans
+    con_id = mapped_column(Integer, nullable=False, default=0)        # scans con visible_id
+    ultima_lectura = mapped_column(DateTime(timezone=True), nullable=True)
+
+
+class ScanBatch(Base):
+    """
+    Registro de lotes de scans (/scans/batch y /scans/stream), por batch_uuid.
+    Un reintento de un batch terminado (terminado_en) se responde desde aquí sin tocar scan_events.
+    Los uploads por stream guardan su avance en cada chunk confirmado (lineas, conteos):
+    un reintento retoma desde la línea registrada.
+    """
+    __tablename__ = "scan_batches"
+
+    batch_uuid = mapped_column(String(64), primary_key=True)
+    lote_id = mapped_column(Integer, nullable=True)
+    user_id = mapped_column(String, nullable=True)
+    device_id = mapped_column(String, nullable=True)
+    scan_count = mapped_column(Integer, default=0)
+    accepted_count = mapped_column(Integer, default=0)
+    duplicate_count = mapped_column(Integer, default=0)
+    invalid_sig_count = mapped_column(Integer, default=0)       # firma HMAC inválida
+    rejected_count = mapped_column(Integer, default=0)          # no insertados por firma inválida
+    duplicates = mapped_column(JSON, nullable=True)             # tokens no insertados
+    estado = mapped_column(String(16), nullable=True)           # EN_PROCESO | ERROR | COMPLETADO
+    lineas = mapped_column(Integer, default=0)                  # stream: líneas ya confirmadas
+    chunks = mapped_column(Integer, default=0)                  # stream: INSERTs hechos
+    error = mapped_column(String, nullable=True)
+    creado_en = mapped_column(DateTime, default=datetime.utcnow)
+    actualizado_en = mapped_column(DateTime, nullable=True)
+    terminado_en = mapped_column(DateTime, nullable=True)
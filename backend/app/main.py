@@ -6,6 +6,7 @@ load_dotenv(BASE_DIR / ".env")
 
 from fastapi import FastAPI
 from app.db.base import init_db
+from app.services import print_run_service, qr_service, scan_index
 from app.api import (
     routes_setup,
     routes_users,
@@ -39,3 +40,15 @@ app.include_router(routes_reports.router)
 app.include_router(routes_lotes.router)
 app.include_router(routes_vigilancia.router)
 
+
+@app.on_event("startup")
+def on_startup():
+    print_run_service.iniciar_workers()
+    scan_index.iniciar()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    print_run_service.detener_workers()
+    scan_index.detener()
+    qr_service.detener_pool()
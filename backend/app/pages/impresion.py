@@ -66,7 +66,47 @@ def pestaña_impresion():
             }
         )
 
+        # /qr/print solo encola la corrida: el avance se consulta en /qr/runs/{run_id}
         if r.status_code == 200:
-            st.toast("Impresión enviada correctamente 🖨️", icon="✅")
+            st.session_state.ultima_corrida = r.json().get("run_id")
+            st.toast("Impresión encolada 🖨️", icon="⏳")
         else:
             st.error("Error al imprimir")
+
+    mostrar_corrida(st.session_state.get("ultima_corrida"))
+
+
+# Avance de la última corrida de impresión (filas enviadas / con error)
+def mostrar_corrida(run_id):
+    if not run_id:
+        return
+
+    try:
+        r = requests.get(f"{API}/qr/runs/{run_id}", timeout=5)
+    except Exception as e:
+        st.warning(f"No se pudo consultar la corrida: {e}")
+        return
+    if r.status_code != 200:
+        st.warning("No se pudo consultar la corrida")
+        return
+
+    run = r.json()
+    total = run.get("filas_total") or 0
+    enviadas = run.get("filas_enviadas") or 0
+    fallidas = run.get("filas_fallidas") or 0
+    st.progress(
+        (enviadas + fallidas) / total if total else 1.0,
+        text=f"Corrida {run_id[:8]}: {run.get('estado')} ({enviadas}/{total} filas, {fallidas} con error)",
+    )
+
+    if run.get("estado") == "COMPLETADO":
+        st.success("Impresión completada ✅")
+    elif run.get("estado") in ("PENDIENTE", "EN_PROCESO"):
+        st.button("🔄 Actualizar estado")
+
+    if fallidas:
+        st.error(f"{fallidas} filas no se imprimieron")
+        r_filas = requests.get(f"{API}/qr/runs/{run_id}/rows", params={"estado": "FALLIDA"}, timeout=5)
+        if r_filas.status_code == 200:
+            for f in r_filas.json().get("items", []):
+                st.caption(f"Fila {f['fila']}: {f.get('error') or 'sin detalle'}")
@@ -5,15 +5,22 @@ Print Agent (FastAPI) - minimal, robust, cross-platform-friendly agent.
 Endpoints:
 - GET  /health
 - GET  /printers          (requires X-Agent-Token)
+- POST /printers/refresh  (requires X-Agent-Token) -> re-detect printers now
 - POST /jobs              (requires X-Agent-Token) -> queues job + worker processes
 - GET  /jobs/{job_id}     (requires X-Agent-Token)
 Config via ENV: AGENT_TOKEN, AGENT_ID, PRINTERS_JSON, DB_PATH
+
+Stored formats: a job may carry "formats" (ZPL ^DF downloads). The agent sends
+each format to a printer only once per printer session and remembers which
+printers already hold which format (the name is the format version).
 """
 import os
 import json
 import logging
 import base64
 import uuid
+import random
+import select
 import socket
 import subprocess
 import sqlite3
@@ -21,8 +28,9 @@ import time
 import threading
 import shutil
 import sys
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+from datetime import datetime, timedelta
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
@@ -34,9 +42,16 @@ AGENT_TOKEN = os.getenv("AGENT_TOKEN", "change-me")
 AGENT_ID = os.getenv("AGENT_ID", "agent-unknown")
 PRINTERS_JSON = os.getenv("PRINTERS_JSON", "[]")  # JSON list of printer configs
 DB_PATH = os.getenv("DB_PATH", "print_agent_jobs.db")
-WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "2"))  # seconds
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", "2"))  # seconds; fallback only, new jobs wake the worker
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "5"))
 RETRY_BACKOFF_BASE = float(os.getenv("RETRY_BACKOFF_BASE", "2"))  # seconds
+RETRY_BACKOFF_MAX = float(os.getenv("RETRY_BACKOFF_MAX", "60"))  # cap on the delay before a retry (seconds)
+STRICT_PRINTER_FIFO = os.getenv("STRICT_PRINTER_FIFO", "0") == "1"  # opt-in: a job waiting for a retry holds back its printer's later jobs
+FORMAT_TTL_SECONDS = float(os.getenv("FORMAT_TTL_SECONDS", "1800"))  # re-download stored formats after this
+PRINTER_WORKERS = int(os.getenv("PRINTER_WORKERS", "4"))  # printers served in parallel (one lane each)
+LANE_FAIR_JOBS = int(os.getenv("LANE_FAIR_JOBS", "20"))  # jobs a lane runs before yielding to waiting printers
+PRINTER_CONN_IDLE_SECONDS = float(os.getenv("PRINTER_CONN_IDLE_SECONDS", "30"))  # keep port-9100 sockets open this long; 0 = one connection per send
+PRINTER_REFRESH_SECONDS = float(os.getenv("PRINTER_REFRESH_SECONDS", "60"))  # re-detect local printers this often; 0 = only on demand
 
 # -----------------------------
 # Logging
@@ -155,20 +170,87 @@ def build_printer_list() -> List[Dict[str, Any]]:
 
     return result
 
-# Build PRINTER_MAP used by worker: map name -> config
-def build_printer_map() -> Dict[str, Dict[str, Any]]:
-    printers = build_printer_list()
-    return {p["name"]: p for p in printers if "name" in p}
+# -----------------------------
+# Printer registry
+# Detection forks lpstat, so it runs in the background every
+# PRINTER_REFRESH_SECONDS (or on POST /printers/refresh), never per job.
+# Readers take the current snapshot, which is replaced whole and never mutated.
+# -----------------------------
+class PrinterSnapshot(NamedTuple):
+    printers: Tuple[Mapping[str, Any], ...]  # canonical list served by /printers
+    by_name: Mapping[str, Mapping[str, Any]]  # name -> config, used by the worker
+    refreshed_at: float
+
+def _make_snapshot(printers: List[Dict[str, Any]]) -> PrinterSnapshot:
+    frozen = tuple(MappingProxyType(dict(p)) for p in printers)
+    return PrinterSnapshot(
+        printers=frozen,
+        by_name=MappingProxyType({p["name"]: p for p in frozen}),
+        refreshed_at=time.monotonic(),
+    )
 
-# initialize PRINTER_MAP
-PRINTER_MAP = build_printer_map()
-PRINTERS = build_printer_list()  # canonical list served by /printers
+_printer_snapshot = _make_snapshot(build_printer_list())
+_printer_refresh_lock = threading.Lock()
+_MISS_REFRESH_SECONDS = 5  # an unknown printer in POST /jobs triggers a refresh at most this often
+
+def current_printers() -> PrinterSnapshot:
+    return _printer_snapshot
+
+def refresh_printers(max_age: float = 0) -> bool:
+    """
+    Re-detect printers and swap the snapshot if anything changed.
+    Skipped when the snapshot is younger than max_age seconds. Returns True on change.
+    """
+    global _printer_snapshot
+    with _printer_refresh_lock:
+        old = _printer_snapshot
+        if max_age and time.monotonic() - old.refreshed_at < max_age:
+            return False
+        new = _make_snapshot(build_printer_list())
+        changed = [dict(p) for p in new.printers] != [dict(p) for p in old.printers]
+        if not changed:
+            _printer_snapshot = old._replace(refreshed_at=new.refreshed_at)
+            return False
+        _printer_snapshot = new
+
+    added = sorted(set(new.by_name) - set(old.by_name))
+    removed = sorted(set(old.by_name) - set(new.by_name))
+    modified = sorted(n for n in set(old.by_name) & set(new.by_name) if dict(old.by_name[n]) != dict(new.by_name[n]))
+    for name in removed + modified:
+        forget_printer_formats(name)
+    logger.info("Printers changed: added=%s removed=%s modified=%s", added, removed, modified)
+    return True
+
+def printer_refresher_loop(interval: float):
+    while not _worker_stop.wait(interval):
+        try:
+            refresh_printers()
+        except Exception as e:
+            logger.exception("Printer refresh error: %s", e)
 
 # -----------------------------
 # DB helpers (SQLite)
+# SQLite is the durable log of jobs (WAL mode); dispatch is event driven:
+# POST /jobs wakes the worker through a condition variable, and a job is
+# claimed with a single atomic UPDATE ... RETURNING.
+# Each thread uses its own connection (WAL lets readers and the writer overlap).
 # -----------------------------
+_db_local = threading.local()
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def db() -> sqlite3.Connection:
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = _db_local.conn = _connect(DB_PATH)
+    return conn
+
 def init_db(path: str):
-    conn = sqlite3.connect(path, check_same_thread=False)
+    conn = _connect(path)
     conn.execute(
         """
         CREATE TABLE IF NOT EXISTS jobs (
@@ -180,68 +262,170 @@ def init_db(path: str):
             attempts INTEGER NOT NULL DEFAULT 0,
             last_error TEXT,
             created_at TEXT NOT NULL,
-            updated_at TEXT NOT NULL
+            updated_at TEXT NOT NULL,
+            formats TEXT,
+            next_attempt_at TEXT
         )
         """
     )
+    # upgrade DBs created before the "formats" / "next_attempt_at" columns existed
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(jobs)")}
+    if "formats" not in cols:
+        conn.execute("ALTER TABLE jobs ADD COLUMN formats TEXT")
+    if "next_attempt_at" not in cols:
+        conn.execute("ALTER TABLE jobs ADD COLUMN next_attempt_at TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_status_created ON jobs (status, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_jobs_printer_status_created ON jobs (printer, status, created_at)")
+    # jobs left 'processing' by a previous run (crash/restart) go back to the queue
+    res = conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'processing'")
+    if res.rowcount:
+        logger.warning("Requeued %d jobs left in 'processing'", res.rowcount)
     conn.commit()
-    return conn
+    conn.close()
 
-_db_conn = init_db(DB_PATH)
+init_db(DB_PATH)
 
-def db_insert_job(job_id: str, printer: str, payload: bytes, copies: int):
+# -----------------------------
+# Dispatch signal
+# -----------------------------
+_work_cond = threading.Condition()
+_work_pending = False
+
+def notify_worker():
+    global _work_pending
+    with _work_cond:
+        _work_pending = True
+        _work_cond.notify_all()
+
+def wait_for_work(timeout: float):
+    global _work_pending
+    with _work_cond:
+        _work_cond.wait_for(lambda: _work_pending or _worker_stop.is_set(), timeout)
+        _work_pending = False
+
+def db_insert_job(job_id: str, printer: str, payload: bytes, copies: int, formats: Optional[List[Dict[str, str]]] = None):
     now = datetime.utcnow().isoformat()
-    _db_conn.execute(
-        "INSERT INTO jobs (id, printer, payload, copies, status, attempts, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-        (job_id, printer, payload, copies, "queued", 0, now, now),
+    conn = db()
+    conn.execute(
+        "INSERT INTO jobs (id, printer, payload, copies, status, attempts, created_at, updated_at, formats) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (job_id, printer, payload, copies, "queued", 0, now, now, json.dumps(formats) if formats else None),
+    )
+    conn.commit()
+
+# A job waiting for a retry (next_attempt_at in the future) is skipped: the lane
+# claims the oldest *due* job of its printer, so one bad job never blocks the rest.
+# With STRICT_PRINTER_FIFO only the oldest queued job can be claimed, once due;
+# labels then always print in order, but a failing job holds its printer's queue
+# until it succeeds or runs out of retries.
+_DUE = "(next_attempt_at IS NULL OR next_attempt_at <= ?)"
+
+_CLAIM_SQL = f"""
+    UPDATE jobs SET status = 'processing', attempts = attempts + 1, updated_at = ?
+    WHERE id = (
+        SELECT id FROM jobs WHERE printer = ? AND status = 'queued' AND {_DUE} ORDER BY created_at LIMIT 1
+    )
+      AND status = 'queued'
+    RETURNING id, printer, payload, copies, attempts, formats
+"""
+
+_CLAIM_FIFO_SQL = f"""
+    UPDATE jobs SET status = 'processing', attempts = attempts + 1, updated_at = ?
+    WHERE id = (
+        SELECT id FROM jobs WHERE printer = ? AND status = 'queued' ORDER BY created_at LIMIT 1
     )
-    _db_conn.commit()
+      AND status = 'queued'
+      AND {_DUE}
+    RETURNING id, printer, payload, copies, attempts, formats
+"""
 
-def db_fetch_one_queued():
-    cur = _db_conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1")
-    row = cur.fetchone()
-    if not row:
+def db_claim_next(printer_name: str):
+    """
+    Atomically move the oldest due job of this printer to 'processing' and return it
+    (or None if no job is due).
+    """
+    now = datetime.utcnow().isoformat()
+    conn = db()
+    sql = _CLAIM_FIFO_SQL if STRICT_PRINTER_FIFO else _CLAIM_SQL
+    r = conn.execute(sql, (now, printer_name, now)).fetchone()
+    conn.commit()
+    if not r:
         return None
-    job_id = row[0]
+    return {
+        "id": r[0], "printer": r[1], "payload": r[2], "copies": r[3], "attempts": r[4],
+        "formats": json.loads(r[5]) if r[5] else [],
+    }
+
+def db_queued_printers() -> Tuple[List[str], Optional[str]]:
+    """
+    Printers with a job that can be claimed now (the one waiting longest first),
+    and the earliest next_attempt_at among jobs that are not due yet (or None).
+    """
     now = datetime.utcnow().isoformat()
-    res = _db_conn.execute(
-        "UPDATE jobs SET status = 'processing', attempts = attempts + 1, updated_at = ? WHERE id = ? AND status = 'queued'",
-        (now, job_id),
+    if not STRICT_PRINTER_FIFO:
+        cur = db().execute(
+            f"SELECT printer FROM jobs WHERE status = 'queued' AND {_DUE} GROUP BY printer ORDER BY MIN(created_at)",
+            (now,),
+        )
+        due = [r[0] for r in cur.fetchall()]
+        next_due = db().execute(
+            "SELECT MIN(next_attempt_at) FROM jobs WHERE status = 'queued' AND next_attempt_at > ?", (now,)
+        ).fetchone()[0]
+        return due, next_due
+
+    # SQLite: with MIN(), a bare column (next_attempt_at) comes from the row holding the minimum
+    cur = db().execute(
+        "SELECT printer, MIN(created_at), next_attempt_at FROM jobs WHERE status = 'queued' GROUP BY printer ORDER BY 2"
     )
-    _db_conn.commit()
-    if res.rowcount == 1:
-        cur = _db_conn.execute("SELECT id, printer, payload, copies, attempts FROM jobs WHERE id = ?", (job_id,))
-        r = cur.fetchone()
-        if r:
-            return {"id": r[0], "printer": r[1], "payload": r[2], "copies": r[3], "attempts": r[4]}
-    return None
+    due: List[str] = []
+    next_due: Optional[str] = None
+    for printer, _, next_attempt_at in cur.fetchall():
+        if next_attempt_at is None or next_attempt_at <= now:
+            due.append(printer)
+        elif next_due is None or next_attempt_at < next_due:
+            next_due = next_attempt_at
+    return due, next_due
 
 def db_update_job_done(job_id: str):
     now = datetime.utcnow().isoformat()
-    _db_conn.execute("UPDATE jobs SET status = 'done', updated_at = ?, last_error = NULL WHERE id = ?", (now, job_id))
-    _db_conn.commit()
+    conn = db()
+    conn.execute("UPDATE jobs SET status = 'done', updated_at = ?, last_error = NULL WHERE id = ?", (now, job_id))
+    conn.commit()
 
 def db_update_job_failed(job_id: str, error_msg: str):
     now = datetime.utcnow().isoformat()
-    _db_conn.execute(
+    conn = db()
+    conn.execute(
         "UPDATE jobs SET status = 'failed', last_error = ?, updated_at = ? WHERE id = ?",
         (error_msg[:1000], now, job_id),
     )
-    _db_conn.commit()
+    conn.commit()
+
+def retry_delay(attempts: int) -> float:
+    """
+    Exponential backoff with jitter: between half and all of min(RETRY_BACKOFF_MAX, base ** attempts),
+    so jobs that failed together do not all retry at the same instant.
+    """
+    delay = min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE ** attempts)
+    return delay / 2 + random.uniform(0, delay / 2)
 
 def db_requeue_with_backoff(job_id: str, attempts: int, error_msg: str):
     if attempts >= MAX_RETRIES:
         db_update_job_failed(job_id, f"Max retries reached: {error_msg}")
         return
-    now = datetime.utcnow().isoformat()
-    _db_conn.execute(
-        "UPDATE jobs SET status = 'queued', last_error = ?, updated_at = ? WHERE id = ?",
-        (error_msg[:1000], now, job_id),
+    now = datetime.utcnow()
+    next_attempt_at = now + timedelta(seconds=retry_delay(attempts))
+    conn = db()
+    conn.execute(
+        "UPDATE jobs SET status = 'queued', last_error = ?, updated_at = ?, next_attempt_at = ? WHERE id = ?",
+        (error_msg[:1000], now.isoformat(), next_attempt_at.isoformat(), job_id),
     )
-    _db_conn.commit()
+    conn.commit()
 
 def db_get_job(job_id: str):
-    cur = _db_conn.execute("SELECT id, printer, attempts, status, last_error, created_at, updated_at FROM jobs WHERE id = ?", (job_id,))
+    cur = db().execute(
+        "SELECT id, printer, attempts, status, last_error, created_at, updated_at, next_attempt_at FROM jobs WHERE id = ?",
+        (job_id,),
+    )
     r = cur.fetchone()
     if not r:
         return None
@@ -253,17 +437,144 @@ def db_get_job(job_id: str):
         "last_error": r[4],
         "created_at": r[5],
         "updated_at": r[6],
+        "next_attempt_at": r[7],
     }
 
+# -----------------------------
+# Stored formats per printer (ZPL ^DF)
+# printer name -> {format name: loaded at (epoch)}
+# Printers keep formats in RAM (R:), so this is per printer session: it is
+# forgotten on any send error and expires after FORMAT_TTL_SECONDS.
+# -----------------------------
+_printer_formats: Dict[str, Dict[str, float]] = {}
+_printer_formats_lock = threading.Lock()
+
+def formats_pending(printer_name: str, formats: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    now = time.time()
+    with _printer_formats_lock:
+        held = _printer_formats.get(printer_name, {})
+        return [f for f in formats if now - held.get(f["name"], float("-inf")) > FORMAT_TTL_SECONDS]
+
+def mark_formats_loaded(printer_name: str, names: List[str]):
+    if not names:
+        return
+    now = time.time()
+    with _printer_formats_lock:
+        held = _printer_formats.setdefault(printer_name, {})
+        for name in names:
+            held[name] = now
+
+def forget_printer_formats(printer_name: str):
+    with _printer_formats_lock:
+        _printer_formats.pop(printer_name, None)
+
+def printer_formats(printer_name: str) -> List[str]:
+    with _printer_formats_lock:
+        return sorted(_printer_formats.get(printer_name, {}))
+
+# -----------------------------
+# Network printer connections (port 9100)
+# One socket per host:port, kept open between sends (TCP keepalive on) and
+# closed after PRINTER_CONN_IDLE_SECONDS idle, since many printers accept a
+# single connection at a time. A reused socket is checked before sending and,
+# if the printer dropped it, the send is retried once on a new connection.
+# -----------------------------
+class PrinterConnection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.sock: Optional[socket.socket] = None
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+    def _open(self, timeout: float):
+        s = socket.create_connection((self.host, self.port), timeout=timeout)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for opt, value in (("TCP_KEEPIDLE", 15), ("TCP_KEEPINTVL", 5), ("TCP_KEEPCNT", 3)):
+            if hasattr(socket, opt):  # not on every platform
+                s.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+        self.sock = s
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def idle(self) -> bool:
+        return time.monotonic() - self.last_used > PRINTER_CONN_IDLE_SECONDS
+
+    def healthy(self) -> bool:
+        """
+        Open, not idle too long and not closed by the printer. Anything the
+        printer sent back (status replies) is discarded.
+        """
+        if self.sock is None or self.idle():
+            return False
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable and not self.sock.recv(4096):
+                return False  # EOF: printer closed the connection
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def send(self, data: bytes, timeout: float):
+        reused = self.healthy()
+        if not reused:
+            self.close()
+            self._open(timeout)
+        try:
+            self.sock.sendall(data)
+        except OSError:
+            self.close()
+            if not reused:
+                raise
+            self._open(timeout)  # stale socket: reconnect once
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                raise
+        self.last_used = time.monotonic()
+        if PRINTER_CONN_IDLE_SECONDS <= 0:
+            self.close()
+
+_printer_conns: Dict[tuple, PrinterConnection] = {}
+_printer_conns_lock = threading.Lock()
+
+def printer_connection(host: str, port: int) -> PrinterConnection:
+    key = (host, int(port))
+    with _printer_conns_lock:
+        conn = _printer_conns.get(key)
+        if conn is None:
+            conn = _printer_conns[key] = PrinterConnection(host, int(port))
+        return conn
+
+def close_idle_printer_connections(force: bool = False):
+    with _printer_conns_lock:
+        conns = list(_printer_conns.values())
+    for conn in conns:
+        # a connection in use is skipped; it is checked again on the next sweep
+        if conn.lock.acquire(blocking=force):
+            try:
+                if force or conn.idle():
+                    conn.close()
+            finally:
+                conn.lock.release()
+
 # -----------------------------
 # Printing backends
 # -----------------------------
 def send_to_network_printer(host: str, port: int, data: bytes, timeout: int = 10):
-    try:
-        with socket.create_connection((host, int(port)), timeout=timeout) as s:
-            s.sendall(data)
-    except Exception as e:
-        raise RuntimeError(f"Network send error to {host}:{port} -> {e}")
+    conn = printer_connection(host, port)
+    with conn.lock:
+        try:
+            conn.send(data, timeout)
+        except Exception as e:
+            raise RuntimeError(f"Network send error to {host}:{port} -> {e}")
 
 def send_to_command_printer(cmd: List[str], data: bytes, timeout: int = 30):
     try:
@@ -301,82 +612,139 @@ def send_to_windows_printer(printer_name: str, data: bytes):
 # -----------------------------
 _worker_stop = threading.Event()
 
-def worker_loop(poll_interval: float):
-    logger.info("Worker started, polling every %s seconds", poll_interval)
-    while not _worker_stop.is_set():
-        try:
-            job = db_fetch_one_queued()
-            if not job:
-                time.sleep(poll_interval)
-                continue
+def process_job(job: Dict[str, Any]):
+    job_id = job["id"]
+    printer_name = job["printer"]
+    payload = job["payload"]
+    copies = int(job["copies"])
+    attempts = int(job["attempts"])
+
+    logger.info("Processing job %s -> printer=%s attempts=%s", job_id, printer_name, attempts)
+
+    p = current_printers().by_name.get(printer_name)
+    if not p:
+        err = f"Printer config '{printer_name}' not found"
+        logger.error(err)
+        db_update_job_failed(job_id, err)
+        return
 
-            job_id = job["id"]
-            printer_name = job["printer"]
-            payload = job["payload"]
-            copies = int(job["copies"])
-            attempts = int(job["attempts"])
+    # stored formats this printer does not hold yet go in front of the first copy
+    pending = formats_pending(printer_name, job.get("formats") or [])
+    prefix = b"".join(base64.b64decode(f["raw_base64"]) for f in pending)
+    datas = [prefix + payload] + [payload] * (copies - 1)
 
-            logger.info("Processing job %s -> printer=%s attempts=%s", job_id, printer_name, attempts)
+    try:
+        if p.get("type") == "network":
+            host = p.get("host")
+            port = p.get("port", 9100)
+            if not host:
+                raise RuntimeError("Printer config missing host")
+            for data in datas:
+                send_to_network_printer(host, port, data)
+        elif p.get("type") == "command":
+            cmd = p.get("cmd")
+            if isinstance(cmd, str):
+                cmd_list = cmd.split()
+            else:
+                cmd_list = cmd
+            for data in datas:
+                send_to_command_printer(cmd_list, data)
+        elif p.get("type") == "windows":
+            for data in datas:
+                send_to_windows_printer(printer_name, data)
+        elif p.get("type") == "local":
+            # local without lp command; fail gracefully
+            raise RuntimeError("Printer type 'local' unsupported for automatic printing (no command provided)")
+        else:
+            raise RuntimeError(f"Unsupported printer type: {p.get('type')}")
+    except Exception as e:
+        logger.exception("Job %s printing error: %s", job_id, e)
+        # printer may have restarted: download formats again next time
+        forget_printer_formats(printer_name)
+        # not due again until next_attempt_at; the lane moves on to other work
+        db_requeue_with_backoff(job_id, attempts, str(e))
+        return
 
-            # Refresh PRINTER_MAP every job in case runtime printers changed (e.g. new lpstat)
-            global PRINTER_MAP
-            PRINTER_MAP = build_printer_map()
+    mark_formats_loaded(printer_name, [f["name"] for f in pending])
+    db_update_job_done(job_id)
+    logger.info("Job %s done", job_id)
 
-            p = PRINTER_MAP.get(printer_name)
-            if not p:
-                err = f"Printer config '{printer_name}' not found"
-                logger.error(err)
-                db_update_job_failed(job_id, err)
-                continue
+# Lanes: one thread per printer with due jobs (at most PRINTER_WORKERS at a time).
+# A lane runs its printer's due jobs in order and exits when none is left (jobs
+# waiting for a retry are picked up later), so a slow or offline printer only
+# delays its own jobs.
+_lanes: Dict[str, threading.Thread] = {}
+_lanes_lock = threading.Lock()
+_lanes_backlog = threading.Event()  # printers are waiting for a free lane
 
+def lane_loop(printer_name: str):
+    done = 0
+    try:
+        while not _worker_stop.is_set():
+            job = db_claim_next(printer_name)
+            if not job:
+                break
             try:
-                if p.get("type") == "network":
-                    host = p.get("host")
-                    port = p.get("port", 9100)
-                    if not host:
-                        raise RuntimeError("Printer config missing host")
-                    for i in range(copies):
-                        send_to_network_printer(host, port, payload)
-                elif p.get("type") == "command":
-                    cmd = p.get("cmd")
-                    if isinstance(cmd, str):
-                        cmd_list = cmd.split()
-                    else:
-                        cmd_list = cmd
-                    for i in range(copies):
-                        send_to_command_printer(cmd_list, payload)
-                elif p.get("type") == "windows":
-                    for i in range(copies):
-                        send_to_windows_printer(printer_name, payload)
-                elif p.get("type") == "local":
-                    # local without lp command; fail gracefully
-                    raise RuntimeError("Printer type 'local' unsupported for automatic printing (no command provided)")
-                else:
-                    raise RuntimeError(f"Unsupported printer type: {p.get('type')}")
+                process_job(job)
             except Exception as e:
-                logger.exception("Job %s printing error: %s", job_id, e)
-                db_requeue_with_backoff(job_id, attempts, str(e))
-                time.sleep(min(10, RETRY_BACKOFF_BASE ** attempts))
-                continue
-
-            db_update_job_done(job_id)
-            logger.info("Job %s done", job_id)
+                logger.exception("Lane %s unexpected error: %s", printer_name, e)
+                db_requeue_with_backoff(job["id"], int(job["attempts"]), str(e))
+            done += 1
+            if done >= LANE_FAIR_JOBS and _lanes_backlog.is_set():
+                break  # yield the slot; the dispatcher starts a lane again later
+    finally:
+        with _lanes_lock:
+            _lanes.pop(printer_name, None)
+        notify_worker()
 
+def worker_loop(poll_interval: float):
+    """
+    Dispatcher: starts a lane for each printer with due jobs, up to PRINTER_WORKERS.
+    Sleeps until a job is posted, a lane ends or the next retry is due.
+    """
+    logger.info(
+        "Dispatcher started (max %s printer lanes, woken by new jobs, fallback poll every %s seconds)",
+        PRINTER_WORKERS, poll_interval,
+    )
+    while not _worker_stop.is_set():
+        timeout = poll_interval
+        try:
+            waiting, next_due = db_queued_printers()
+            with _lanes_lock:
+                waiting = [p for p in waiting if p not in _lanes]
+                free = max(0, PRINTER_WORKERS - len(_lanes))
+                for printer_name in waiting[:free]:
+                    t = threading.Thread(target=lane_loop, args=(printer_name,), name=f"lane-{printer_name}", daemon=True)
+                    _lanes[printer_name] = t
+                    t.start()
+            if len(waiting) > free:
+                _lanes_backlog.set()
+            else:
+                _lanes_backlog.clear()
+            close_idle_printer_connections()
+            if next_due:
+                until_due = (datetime.fromisoformat(next_due) - datetime.utcnow()).total_seconds()
+                timeout = min(poll_interval, max(0.01, until_due))
         except Exception as e:
-            logger.exception("Worker unexpected error: %s", e)
-            time.sleep(1)
+            logger.exception("Dispatcher unexpected error: %s", e)
+        wait_for_work(timeout)
 
 # -----------------------------
 # FastAPI app and endpoints
 # -----------------------------
 app = FastAPI(title="Print Agent")
 
+class FormatSpec(BaseModel):
+    name: str
+    raw_base64: str
+
 class JobRequest(BaseModel):
     printer: str
     raw_base64: Optional[str] = None
     raw_text: Optional[str] = None
     copies: int = 1
     client_job_id: Optional[str] = None
+    formats: Optional[List[FormatSpec]] = None
 
 def require_token(request: Request):
     token = request.headers.get("X-Agent-Token")
@@ -387,26 +755,28 @@ def require_token(request: Request):
 def on_startup():
     t = threading.Thread(target=worker_loop, args=(WORKER_POLL_INTERVAL,), daemon=True)
     t.start()
-    logger.info("Agent %s starting. Printers: %s", AGENT_ID, list(PRINTER_MAP.keys()))
+    if PRINTER_REFRESH_SECONDS > 0:
+        threading.Thread(target=printer_refresher_loop, args=(PRINTER_REFRESH_SECONDS,), daemon=True).start()
+    logger.info("Agent %s starting. Printers: %s", AGENT_ID, list(current_printers().by_name))
 
 @app.on_event("shutdown")
 def on_shutdown():
     _worker_stop.set()
+    notify_worker()
+    close_idle_printer_connections(force=True)
     logger.info("Agent shutting down")
 
 @app.get("/health")
 def health():
-    return {"ok": True, "agent_id": AGENT_ID, "printers": list(PRINTER_MAP.keys())}
+    return {"ok": True, "agent_id": AGENT_ID, "printers": list(current_printers().by_name)}
 
 @app.get("/printers")
 def list_printers(request: Request):
     # show both configured and detected printers; token required
     require_token(request)
-    # rebuild to include any runtime-detected printers
-    combined = build_printer_list()
     # Only include select fields in response
     out = []
-    for p in combined:
+    for p in current_printers().printers:
         entry = {
             "name": p.get("name"),
             "type": p.get("type"),
@@ -417,17 +787,23 @@ def list_printers(request: Request):
             entry["port"] = p.get("port", 9100)
         if p.get("type") == "command":
             entry["cmd"] = p.get("cmd")
+        entry["formats"] = printer_formats(p.get("name"))
         out.append(entry)
     return out
 
+@app.post("/printers/refresh")
+def post_printers_refresh(request: Request):
+    require_token(request)
+    changed = refresh_printers()
+    return {"changed": changed, "printers": list(current_printers().by_name)}
+
 @app.post("/jobs")
 def post_job(job: JobRequest, request: Request):
     require_token(request)
-    # validate printer exists in current map
-    # rebuild PRINTER_MAP to ensure we include detected printers
-    global PRINTER_MAP
-    PRINTER_MAP = build_printer_map()
-    if job.printer not in PRINTER_MAP:
+    # validate printer exists; an unknown name may be a printer plugged in since the last refresh
+    if job.printer not in current_printers().by_name:
+        refresh_printers(max_age=_MISS_REFRESH_SECONDS)
+    if job.printer not in current_printers().by_name:
         raise HTTPException(status_code=404, detail=f"Printer '{job.printer}' not found")
     if job.raw_base64:
         try:
@@ -440,12 +816,25 @@ def post_job(job: JobRequest, request: Request):
         raise HTTPException(status_code=400, detail="Provide raw_base64 or raw_text")
     if job.copies < 1 or job.copies > 100:
         raise HTTPException(status_code=400, detail="copies must be between 1 and 100")
+    formats = []
+    for f in job.formats or []:
+        try:
+            base64.b64decode(f.raw_base64, validate=True)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid base64 format '{f.name}': {e}")
+        formats.append({"name": f.name, "raw_base64": f.raw_base64})
     job_id = job.client_job_id or str(uuid.uuid4())
+    # idempotente: un client_job_id ya recibido no se vuelve a encolar
+    if job.client_job_id:
+        existing = db_get_job(job_id)
+        if existing:
+            return {"job_id": job_id, "status": existing["status"]}
     try:
-        db_insert_job(job_id, job.printer, payload, int(job.copies))
+        db_insert_job(job_id, job.printer, payload, int(job.copies), formats)
     except Exception as e:
         logger.exception("Failed inserting job: %s", e)
         raise HTTPException(status_code=500, detail="Failed to persist job")
+    notify_worker()
     logger.info("Job %s queued for printer %s (copies=%s)", job_id, job.printer, job.copies)
     return {"job_id": job_id, "status": "queued"}
 
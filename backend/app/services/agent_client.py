@@ -60,12 +60,17 @@ def enviar_job_agente(
     copies: int = 1,
     agent_url: Optional[str] = None,
     agent_id: Optional[str] = None,
+    client_job_id: Optional[str] = None,
+    formatos: Optional[Dict[str, str]] = None,
     timeout: int = 15,
 ) -> Dict[str, Any]:
     """
     Envía un job ZPL al Print Agent.
 
     raw: ZPL en string
+    client_job_id: id propuesto al agente (idempotente: reenviarlo no duplica el job)
+    formatos: {nombre: ZPL ^DF} que el agente debe descargar a la impresora
+              (solo si aún no los tiene) antes de imprimir `raw`
     """
     base_url = _resolve_agent_url(agent_url=agent_url, agent_id=agent_id)
     url = f"{base_url}/jobs"
@@ -81,6 +86,13 @@ def enviar_job_agente(
         "raw_base64": base64.b64encode(raw_bytes).decode("utf-8"),
         "copies": int(copies),
     }
+    if client_job_id:
+        payload["client_job_id"] = client_job_id
+    if formatos:
+        payload["formats"] = [
+            {"name": nombre, "raw_base64": base64.b64encode(zpl.encode("utf-8")).decode("utf-8")}
+            for nombre, zpl in formatos.items()
+        ]
 
     r = requests.post(url, json=payload, headers=_headers(), timeout=timeout)
     r.raise_for_status()
@@ -0,0 +1,88 @@
+import io
+import os
+import csv
+import tempfile
+from typing import Any, Dict, Iterable, Iterator, Sequence
+
+from app.db.base import engine
+
+# Filas que trae cada viaje del cursor del lado del servidor
+EXPORT_FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", "5000"))
+
+# Bytes de CSV acumulados antes de enviar un trozo al cliente
+_CSV_CHUNK = 64 * 1024
+
+# Límite de filas de una hoja de Excel (incluye el encabezado)
+_XLSX_MAX_FILAS = 1_048_576
+
+
+def filas_consulta(sql, params: Dict[str, Any]) -> Iterator[Sequence[Any]]:
+    """
+    Encabezado + filas de la consulta, leídas con un cursor del lado del servidor
+    (memoria constante). La conexión vive mientras se consume el iterador.
+    """
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=EXPORT_FETCH_ROWS).execute(sql, params)
+        yield list(result.keys())
+        for parte in result.partitions():
+            yield from parte
+
+
+def csv_stream(filas: Iterable[Sequence[Any]]) -> Iterator[bytes]:
+    """
+    CSV UTF-8 (con BOM, para que Excel muestre bien las tildes) en trozos de ~64 KB.
+    """
+    buffer = io.StringIO()
+    buffer.write("\ufeff")
+    writer = csv.writer(buffer)
+
+    for fila in filas:
+        writer.writerow(fila)
+        if buffer.tell() >= _CSV_CHUNK:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def xlsx_archivo(filas: Iterable[Sequence[Any]], hoja: str = "reporte") -> str:
+    """
+    Escribe un XLSX en un archivo temporal con xlsxwriter en modo constant_memory
+    (cada fila se escribe y se libera). Retorna la ruta; la borra quien la envía.
+    Si se pasa el límite de filas de Excel, continúa en otra hoja con el mismo encabezado.
+    """
+    import xlsxwriter  # opcional: solo para exportar a Excel
+
+    fd, ruta = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+
+    wb = xlsxwriter.Workbook(ruta, {
+        "constant_memory": True,
+        "remove_timezone": True,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+    try:
+        filas = iter(filas)
+        encabezado = next(filas, [])
+        negrita = wb.add_format({"bold": True})
+
+        n_hoja, fila_i, ws = 0, _XLSX_MAX_FILAS, None
+        for fila in filas:
+            if fila_i >= _XLSX_MAX_FILAS:
+                n_hoja += 1
+                ws = wb.add_worksheet(hoja if n_hoja == 1 else f"{hoja}_{n_hoja}")
+                ws.write_row(0, 0, encabezado, negrita)
+                fila_i = 1
+            ws.write_row(fila_i, 0, fila)
+            fila_i += 1
+
+        if ws is None:
+            wb.add_worksheet(hoja).write_row(0, 0, encabezado, negrita)
+        wb.close()
+    except Exception:
+        os.unlink(ruta)
+        raise
+
+    return ruta
@@ -0,0 +1,297 @@
+import os
+import queue
+import uuid
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import insert, select, update
+
+from app.db.base import SessionLocal
+from app.db.models import PrintRun, PrintRunRow
+from app.services.agent_client import enviar_job_agente
+from app.services.ticket_service import items_tickets
+from app.services.zpl_service import generar_zpl_lote, generar_zpl_lote_formato
+
+logger = logging.getLogger(__name__)
+
+# Nº de hilos que envían corridas al agente (cada corrida la procesa un solo hilo)
+PRINT_RUN_WORKERS = int(os.getenv("PRINT_RUN_WORKERS", "2"))
+
+# Una corrida EN_PROCESO sin avance en este tiempo se considera abandonada
+# (p.ej. el proceso murió) y puede retomarse.
+PRINT_RUN_STALE_SECONDS = int(os.getenv("PRINT_RUN_STALE_SECONDS", "300"))
+
+# Filas de 4 etiquetas que se combinan en un solo job del agente (1 = comportamiento clásico)
+PRINT_ROWS_PER_JOB = int(os.getenv("PRINT_ROWS_PER_JOB", "25"))
+MAX_ROWS_PER_JOB = 250
+
+# Formatos almacenados (^DF una vez por impresora, luego solo ^XF + datos).
+# Requiere un Print Agent con soporte de "formats".
+PRINT_STORED_FORMATS = os.getenv("PRINT_STORED_FORMATS", "0") == "1"
+
+# Stock de etiquetas soportado (columnas por fila)
+COLUMNAS_DEFAULT = 4
+COLUMNAS_VALIDAS = (1, 2, 3, 4)
+
+_cola: "queue.Queue[Optional[str]]" = queue.Queue()
+_hilos: List[threading.Thread] = []
+
+
+# ==========================================================
+# CREAR CORRIDA (dentro de la transacción de emisión)
+# ==========================================================
+def crear_corrida(
+    db,
+    *,
+    items: List[Dict[str, Any]],
+    dni: str,
+    nn: str,
+    producto: str,
+    printer: str,
+    agent_url: Optional[str],
+    agent_id: Optional[str],
+    usuario: Optional[str],
+    filas_por_job: Optional[int] = None,
+    columnas: int = COLUMNAS_DEFAULT,
+    formato_almacenado: Optional[bool] = None,
+) -> str:
+    """
+    Registra la corrida y sus filas (`columnas` tokens por fila).
+    No hace commit ni envía nada: eso lo hace el worker tras `encolar`.
+    """
+    run_id = uuid.uuid4().hex
+    filas = [
+        [it["token"] for it in items[i:i + columnas]]
+        for i in range(0, len(items), columnas)
+    ]
+
+    db.add(PrintRun(
+        id=run_id,
+        dni_trabajador=dni,
+        nn=nn,
+        producto=producto,
+        cantidad=len(items),
+        printer=printer,
+        agent_url=agent_url,
+        agent_id=agent_id,
+        columnas=columnas,
+        filas_por_job=filas_por_job or PRINT_ROWS_PER_JOB,
+        formato_almacenado=PRINT_STORED_FORMATS if formato_almacenado is None else formato_almacenado,
+        estado="PENDIENTE",
+        filas_total=len(filas),
+        creado_por=usuario,
+    ))
+    db.flush()
+
+    db.execute(
+        insert(PrintRunRow).values([
+            {"run_id": run_id, "fila": n, "tokens": tokens}
+            for n, tokens in enumerate(filas)
+        ])
+    )
+    return run_id
+
+
+# ==========================================================
+# CONSULTAS
+# ==========================================================
+def resumen_corrida(run: PrintRun) -> Dict[str, Any]:
+    return {
+        "run_id": run.id,
+        "estado": run.estado,
+        "printer": run.printer,
+        "agent_url": run.agent_url,
+        "cantidad": run.cantidad,
+        "columnas": run.columnas,
+        "filas_por_job": run.filas_por_job,
+        "formato_almacenado": run.formato_almacenado,
+        "filas_total": run.filas_total,
+        "filas_enviadas": run.filas_enviadas,
+        "filas_fallidas": run.filas_fallidas,
+        "filas_pendientes": run.filas_total - run.filas_enviadas - run.filas_fallidas,
+        "ultimo_error": run.ultimo_error,
+        "creado_por": run.creado_por,
+        "creado_en": run.creado_en,
+        "actualizado_en": run.actualizado_en,
+        "terminado_en": run.terminado_en,
+    }
+
+
+def reintentar_fallidas(db, run_id: str) -> int:
+    """
+    Devuelve las filas FALLIDA a PENDIENTE para que el worker las reenvíe.
+    Retorna cuántas filas se reencolaron (no hace commit).
+    """
+    res = db.execute(
+        update(PrintRunRow)
+        .where(PrintRunRow.run_id == run_id, PrintRunRow.estado == "FALLIDA")
+        .values(estado="PENDIENTE", error=None, actualizado_en=datetime.utcnow())
+    )
+    n = res.rowcount or 0
+    if n:
+        db.execute(
+            update(PrintRun)
+            .where(PrintRun.id == run_id)
+            .values(
+                estado="PENDIENTE",
+                filas_fallidas=PrintRun.filas_fallidas - n,
+                ultimo_error=None,
+                terminado_en=None,
+                actualizado_en=datetime.utcnow(),
+            )
+        )
+    return n
+
+
+# ==========================================================
+# WORKER
+# ==========================================================
+def encolar(run_id: str):
+    _cola.put(run_id)
+
+
+def _tomar_corrida(db, run_id: str) -> bool:
+    """
+    Reclama la corrida de forma atómica (evita que dos procesos la envíen a la vez).
+    """
+    ahora = datetime.utcnow()
+    limite = ahora - timedelta(seconds=PRINT_RUN_STALE_SECONDS)
+    res = db.execute(
+        update(PrintRun)
+        .where(
+            PrintRun.id == run_id,
+            (PrintRun.estado == "PENDIENTE")
+            | ((PrintRun.estado == "EN_PROCESO") & (PrintRun.actualizado_en < limite)),
+        )
+        .values(estado="EN_PROCESO", actualizado_en=ahora)
+    )
+    db.commit()
+    return (res.rowcount or 0) == 1
+
+
+def _items_fila(run: PrintRun, tokens: List[str]) -> List[Dict[str, Any]]:
+    return items_tickets(tokens, dni=run.dni_trabajador, nn=run.nn, producto=run.producto)
+
+
+def procesar_corrida(run_id: str):
+    with SessionLocal() as db:
+        if not _tomar_corrida(db, run_id):
+            return
+
+        run = db.get(PrintRun, run_id)
+        filas = db.execute(
+            select(PrintRunRow)
+            .where(PrintRunRow.run_id == run_id, PrintRunRow.estado == "PENDIENTE")
+            .order_by(PrintRunRow.fila)
+        ).scalars().all()
+
+        por_job = max(1, min(run.filas_por_job or 1, MAX_ROWS_PER_JOB))
+        logger.info(
+            "Corrida %s: enviando %d filas a %s (%d filas por job)",
+            run_id, len(filas), run.printer, por_job,
+        )
+
+        for i in range(0, len(filas), por_job):
+            grupo = filas[i:i + por_job]
+            filas_items = [_items_fila(run, f.tokens) for f in grupo]
+            zpl_kwargs = {"columnas": run.columnas or COLUMNAS_DEFAULT, "dpi": 203, "qr_mag": 4}
+            if run.formato_almacenado:
+                formatos, zpl = generar_zpl_lote_formato(filas_items, **zpl_kwargs)
+            else:
+                formatos, zpl = None, generar_zpl_lote(filas_items, **zpl_kwargs)
+
+            ahora = datetime.utcnow()
+            for f in grupo:
+                f.intentos += 1
+                f.actualizado_en = ahora
+
+            try:
+                job = enviar_job_agente(
+                    agent_url=run.agent_url,
+                    agent_id=None if run.agent_url else run.agent_id,
+                    printer=run.printer,
+                    raw=zpl,
+                    copies=1,
+                    formatos=formatos,
+                    # id estable por grupo: si la corrida se retoma, el agente no duplica
+                    client_job_id=f"{run_id}-{grupo[0].fila}-{grupo[0].intentos}",
+                )
+                job_id = job.get("job_id") or job.get("id")
+                for f in grupo:
+                    f.job_id = job_id
+                    f.estado = "ENVIADA"
+                    f.error = None
+                run.filas_enviadas += len(grupo)
+            except Exception as e:
+                logger.warning("Corrida %s filas %s-%s fallaron: %s", run_id, grupo[0].fila, grupo[-1].fila, e)
+                for f in grupo:
+                    f.estado = "FALLIDA"
+                    f.error = str(e)[:500]
+                run.filas_fallidas += len(grupo)
+                run.ultimo_error = str(e)[:500]
+
+            run.actualizado_en = ahora
+            db.commit()
+
+        run.estado = "CON_ERRORES" if run.filas_fallidas else "COMPLETADO"
+        run.terminado_en = datetime.utcnow()
+        run.actualizado_en = run.terminado_en
+        db.commit()
+
+        logger.info(
+            "Corrida %s terminada: %s (enviadas=%s fallidas=%s)",
+            run_id, run.estado, run.filas_enviadas, run.filas_fallidas,
+        )
+
+
+def _worker_loop():
+    while True:
+        run_id = _cola.get()
+        if run_id is None:
+            break
+        try:
+            procesar_corrida(run_id)
+        except Exception as e:
+            logger.exception("Error procesando corrida %s: %s", run_id, e)
+
+
+def _reanudar_pendientes():
+    """
+    Al arrancar: reencola corridas que quedaron PENDIENTE o EN_PROCESO abandonadas.
+    """
+    limite = datetime.utcnow() - timedelta(seconds=PRINT_RUN_STALE_SECONDS)
+    with SessionLocal() as db:
+        ids = db.execute(
+            select(PrintRun.id)
+            .where(
+                (PrintRun.estado == "PENDIENTE")
+                | ((PrintRun.estado == "EN_PROCESO") & (PrintRun.actualizado_en < limite))
+            )
+            .order_by(PrintRun.creado_en)
+        ).scalars().all()
+
+    for run_id in ids:
+        encolar(run_id)
+
+    if ids:
+        logger.info("Reanudando %d corridas de impresión", len(ids))
+
+
+def iniciar_workers():
+    if _hilos:
+        return
+    for i in range(max(1, PRINT_RUN_WORKERS)):
+        t = threading.Thread(target=_worker_loop, name=f"print-run-{i}", daemon=True)
+        t.start()
+        _hilos.append(t)
+    try:
+        _reanudar_pendientes()
+    except Exception as e:
+        logger.exception("No se pudo reanudar corridas pendientes: %s", e)
+
+
+def detener_workers():
+    for _ in _hilos:
+        _cola.put(None)
@@ -1,79 +1,98 @@
 import io
-import json
+import os
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
 import qrcode
+from cachetools import TTLCache
 from PIL import Image, ImageDraw, ImageFont
-from app.core.security import sign
+from app.core.security import payload_qr
 
 # Fuente robusta disponible en Linux
 FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
 
+# Tamaño final de la vista previa: 4 px por módulo
+# (antes: box_size=10 y luego reducción al 40%)
+BOX_SIZE = 4
+BORDER = 4
 
-def generar_qr_memoria(token: str, dni: str, numord: str, producto: str):
+# Lotes de al menos este tamaño se reparten en un pool de procesos
+RENDER_PROCESSES = int(os.getenv("QR_RENDER_PROCESSES", str(os.cpu_count() or 1)))
+RENDER_POOL_MIN_ITEMS = 64
+
+# Hoja de contactos (prueba de corrida): A4 a 150 dpi
+HOJA_DPI = 150
+HOJA_W, HOJA_H = 1240, 1754
+HOJA_MARGEN = 40
+HOJA_BOX_SIZE = 2     # ~21 mm por QR, cercano a la etiqueta real de 25 mm
+HOJA_PIE = 18         # alto del texto bajo cada QR
+HOJA_SEP = 12
+
+# Cache de vistas previas (/qr/preview): LRU acotado + expiración
+PREVIEW_CACHE_SIZE = int(os.getenv("QR_PREVIEW_CACHE_SIZE", "512"))
+PREVIEW_CACHE_TTL = int(os.getenv("QR_PREVIEW_CACHE_TTL", "3600"))  # segundos
+
+# Token fijo de vista previa (no se guarda): con él la imagen depende solo de (dni, nn, producto)
+TOKEN_PREVIEW = "VP"
+
+
+@lru_cache(maxsize=32)
+def _fuente(size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(FONT_PATH, size)
+
+
+def _matriz_qr(data: str) -> np.ndarray:
     """
-    Genera un QR en memoria con:
-    - Payload firmado
-    - Número de orden (numord) visible en el centro
-    - Cuadro blanco centrado
-    - Texto perfectamente centrado dentro del cuadro
+    Matriz de módulos (True = negro), incluyendo la quiet zone.
+    ECC H: alta tolerancia para el overlay central.
     """
-
-    # ------------------------------------------------------------------
-    # 1) Construcción del payload + firma
-    # ------------------------------------------------------------------
-    base = f"{token}|{dni}|{numord}|{producto}|1"
-
-    payload = {
-        "t": token,
-        "dni": dni,
-        "id": numord,      # número de orden visual (3 dígitos)
-        "p": producto,
-        "v": 1,
-        "sig": sign(base)
-    }
-
-    data = json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
-
-    # ------------------------------------------------------------------
-    # 2) Generación del QR (alta tolerancia para overlay central)
-    # ------------------------------------------------------------------
     qr = qrcode.QRCode(
         version=None,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,  # margen alto
-        box_size=10,
-        border=4
+        error_correction=qrcode.constants.ERROR_CORRECT_H,
+        box_size=1,
+        border=BORDER
     )
     qr.add_data(data)
     qr.make(fit=True)
+    return np.asarray(qr.get_matrix(), dtype=bool)
 
-    img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
 
-    # ------------------------------------------------------------------
-    # 3) Preparación para dibujo
-    # ------------------------------------------------------------------
+def render_qr(token: str, dni: str, numord: str, producto: str, box_size: int = BOX_SIZE) -> Image.Image:
+    """
+    Dibuja el QR directamente a la resolución final (escala de grises):
+    - Payload firmado
+    - Número de orden (numord) visible en el centro
+    - Cuadro blanco centrado, texto centrado dentro del cuadro
+    """
+    # 1) Matriz -> píxeles (cada módulo = box_size x box_size)
+    modulos = _matriz_qr(payload_qr(token, dni, numord, producto))
+    px = np.where(modulos, 0, 255).astype(np.uint8)
+    px = np.repeat(np.repeat(px, box_size, axis=0), box_size, axis=1)
+
+    img = Image.fromarray(px)  # uint8 2D -> modo "L"
+
+    # 2) Overlay central
     draw = ImageDraw.Draw(img)
     w, h = img.size
-
-    # Centro geométrico exacto del QR
     cx, cy = w // 2, h // 2
 
-    # Fuente proporcional al tamaño del QR
-    font_size = int(w * 0.18)  # 18% del ancho total
-    font = ImageFont.truetype(FONT_PATH, font_size)
+    # Fuente proporcional al tamaño del QR (18% del ancho total)
+    font_size = int(w * 0.18)
+    font = _fuente(font_size)
 
-    # ------------------------------------------------------------------
-    # 4) Medición correcta del texto (centrado real)
-    # ------------------------------------------------------------------
     # IMPORTANTE: usar anchor="mm" para medición y dibujo coherentes
     bbox = draw.textbbox((0, 0), numord, font=font, anchor="mm")
     text_width = bbox[2] - bbox[0]
     text_height = bbox[3] - bbox[1]
 
-    # Padding del cuadro blanco
     padding = int(font_size * 0.20)
 
-    # ------------------------------------------------------------------
-    # 5) Cuadro blanco perfectamente centrado
-    # ------------------------------------------------------------------
     draw.rectangle(
         [
             cx - (text_width // 2) - padding,
@@ -81,39 +100,174 @@ def generar_qr_memoria(token: str, dni: str, numord: str, producto: str):
             cx + (text_width // 2) + padding,
             cy + (text_height // 2) + padding,
         ],
-        fill="white"
+        fill=255
     )
+    draw.text((cx, cy), numord, fill=0, font=font, anchor="mm")
 
-    # ------------------------------------------------------------------
-    # 6) Texto perfectamente centrado dentro del cuadro
-    # ------------------------------------------------------------------
-    draw.text(
-        (cx, cy),
-        numord,
-        fill="black",
-        font=font,
-        anchor="mm"   # 🔑 CLAVE ABSOLUTA DEL CENTRADO CORRECTO
-    )
-
-    # ------------------------------------------------------------------
-    # 7) REDUCCIÓN DE TAMAÑO (20% menos, sin alterar contenido)
-    # ------------------------------------------------------------------
-    scale = 0.4  # 🔹 reducir 60%
+    return img
 
-    new_w = int(img.width * scale)
-    new_h = int(img.height * scale)
 
-    img = img.resize(
-        (new_w, new_h),
-        resample=Image.Resampling.LANCZOS  
-    )
-
-    # ------------------------------------------------------------------
-    # 8) Retorno del QR en memoria
-    # ------------------------------------------------------------------
+def _png(img: Image.Image) -> bytes:
     buffer = io.BytesIO()
     img.save(buffer, format="PNG")
-    buffer.seek(0)
+    return buffer.getvalue()
 
+
+def generar_qr_memoria(token: str, dni: str, numord: str, producto: str):
+    """
+    Genera la vista previa PNG de un ticket en memoria (BytesIO).
+    """
+    buffer = io.BytesIO(_png(render_qr(token, dni, numord, producto)))
+    buffer.seek(0)
     return buffer
 
+
+# ==========================================================
+# VISTA PREVIA CACHEADA
+# ==========================================================
+_preview_cache: "TTLCache[Tuple[str, str, str], Tuple[bytes, str]]" = TTLCache(
+    maxsize=PREVIEW_CACHE_SIZE, ttl=PREVIEW_CACHE_TTL
+)
+_preview_lock = threading.Lock()
+
+
+def preview_cacheado(dni: str, numord: str, producto: str) -> Tuple[bytes, str]:
+    """
+    PNG de vista previa + ETag. Se renderiza una sola vez por (dni, numord, producto)
+    mientras siga en el cache (LRU de PREVIEW_CACHE_SIZE, TTL de PREVIEW_CACHE_TTL).
+    """
+    key = (dni, numord, producto)
+    with _preview_lock:
+        hit = _preview_cache.get(key)
+    if hit:
+        return hit
+
+    png = _png(render_qr(TOKEN_PREVIEW, dni, numord, producto))
+    etag = '"' + hashlib.sha1(png).hexdigest()[:20] + '"'
+
+    with _preview_lock:
+        _preview_cache[key] = (png, etag)
+    return png, etag
+
+
+# ==========================================================
+# LOTES (pool de procesos)
+# ==========================================================
+Ticket = Tuple[str, str, str, str]   # (token, dni, numord, producto)
+
+
+def _preview_png(t: Ticket) -> bytes:
+    return _png(render_qr(*t))
+
+
+# Un solo pool para todo el proceso, creado al primer lote grande.
+# "spawn": los hijos arrancan limpios (sin heredar hilos, locks ni conexiones de la BD de uvicorn).
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _pool_compartido() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, RENDER_PROCESSES),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def detener_pool() -> None:
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _mapear(fn, items: Sequence, procesos: int = None, minimo: int = RENDER_POOL_MIN_ITEMS) -> List:
+    global _pool
+    procesos = RENDER_PROCESSES if procesos is None else procesos
+    if procesos <= 1 or len(items) < minimo:
+        return [fn(it) for it in items]
+
+    pool = _pool_compartido()
+    try:
+        return list(pool.map(fn, items, chunksize=max(1, len(items) // (procesos * 4))))
+    except BrokenProcessPool:
+        # un hijo murió: el pool ya no sirve, el próximo lote arma otro
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
+
+
+def generar_previews_lote(items: Iterable[Ticket], procesos: int = None) -> List[bytes]:
+    """
+    Vistas previas PNG de muchos tickets, en el mismo orden.
+    """
+    return _mapear(_preview_png, list(items), procesos)
+
+
+def _render_pagina(items: Sequence[Ticket]) -> bytes:
+    """
+    Una página A4 bitonal (modo "1") con la grilla de QRs y el token debajo.
+    Retorna los bytes crudos de la imagen (ligeros de pasar entre procesos).
+    """
+    pagina = Image.new("1", (HOJA_W, HOJA_H), 1)
+    draw = ImageDraw.Draw(pagina)
+    font = _fuente(12)
+
+    x, y = HOJA_MARGEN, HOJA_MARGEN
+    fila_h = 0
+    for t in items:
+        qr = render_qr(*t, box_size=HOJA_BOX_SIZE)
+        if x + qr.width > HOJA_W - HOJA_MARGEN:
+            x = HOJA_MARGEN
+            y += fila_h + HOJA_PIE + HOJA_SEP
+            fila_h = 0
+
+        pagina.paste(qr.convert("1", dither=Image.Dither.NONE), (x, y))
+        draw.text((x + qr.width // 2, y + qr.height + 2), t[0], fill=0, font=font, anchor="mt")
+
+        x += qr.width + HOJA_SEP
+        fila_h = max(fila_h, qr.height)
+
+    return pagina.tobytes()
+
+
+def _por_pagina(muestra: Ticket) -> Tuple[int, int]:
+    lado = render_qr(*muestra, box_size=HOJA_BOX_SIZE).width
+    cols = max(1, (HOJA_W - 2 * HOJA_MARGEN + HOJA_SEP) // (lado + HOJA_SEP))
+    filas = max(1, (HOJA_H - 2 * HOJA_MARGEN + HOJA_SEP) // (lado + HOJA_PIE + HOJA_SEP))
+    return cols, filas
+
+
+def generar_hoja_contactos_pdf(items: Iterable[Ticket], procesos: int = None) -> io.BytesIO:
+    """
+    Hoja de contactos PDF (prueba de corrida): todos los tickets en grilla A4.
+    Supone tickets de la misma corrida (mismo tamaño de QR).
+    """
+    items = list(items)
+    if not items:
+        raise ValueError("Sin tickets")
+
+    cols, filas = _por_pagina(items[0])
+    n = cols * filas
+    lotes = [items[i:i + n] for i in range(0, len(items), n)]
+
+    paginas = [
+        Image.frombytes("1", (HOJA_W, HOJA_H), raw)
+        for raw in _mapear(_render_pagina, lotes, procesos, minimo=2)
+    ]
+
+    buffer = io.BytesIO()
+    paginas[0].save(
+        buffer,
+        format="PDF",
+        save_all=True,
+        append_images=paginas[1:],
+        resolution=HOJA_DPI,
+    )
+    buffer.seek(0)
+    return buffer
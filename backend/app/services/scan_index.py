@@ -0,0 +1,248 @@
+import os
+import math
+import hashlib
+import logging
+import threading
+from typing import Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import text
+
+from app.db.base import engine
+
+logger = logging.getLogger(__name__)
+
+# Índice en memoria de tokens escaneados (filtro de Bloom) para /scans/exists:
+# "quizás" se confirma por token; "no está" solo se confirma contra las filas
+# posteriores al último refresco (las de otros procesos que el filtro aún no tiene).
+SCAN_INDEX_ENABLED = os.getenv("SCAN_INDEX_ENABLED", "1") == "1"
+SCAN_INDEX_CAPACITY = int(os.getenv("SCAN_INDEX_CAPACITY", "5000000"))
+SCAN_INDEX_FP_RATE = float(os.getenv("SCAN_INDEX_FP_RATE", "0.001"))
+
+# Cada cuánto se leen los tokens insertados por otros procesos (segundos)
+SCAN_INDEX_REFRESH_SECONDS = float(os.getenv("SCAN_INDEX_REFRESH_SECONDS", "5"))
+
+_LEER_LOTE = 20000
+
+# Marca de ingesta: las transacciones confirman en otro orden que el que tomaron de una secuencia,
+# así que "lo nuevo desde X" se lee por ingest_xid (txid de la transacción que insertó).
+# Toda transacción con txid < xmin del snapshot ya terminó: sus filas son visibles
+# (o no existirán nunca). Las que siguen en curso tienen txid >= marca y se leen después.
+_MARCA_SQL = text("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+
+
+def marca_confirmada(conn) -> int:
+    """
+    Marca segura para lecturas incrementales: leerla ANTES de la consulta de datos;
+    la lectura siguiente pide ingest_xid >= marca (puede repetir filas, nunca saltarlas).
+    """
+    return int(conn.execute(_MARCA_SQL).scalar())
+
+
+class FiltroBloom:
+    """
+    Filtro de Bloom sobre un bytearray. Doble hashing (blake2b 128 bits):
+    k posiciones = h1 + i*h2 (mod m). Sin falsos negativos.
+    """
+
+    __slots__ = ("m", "k", "bits", "n", "capacidad")
+
+    def __init__(self, capacidad: int, fp_rate: float):
+        capacidad = max(1, capacidad)
+        self.capacidad = capacidad
+        self.m = max(8, int(-capacidad * math.log(fp_rate) / (math.log(2) ** 2)))
+        self.k = max(1, round(self.m / capacidad * math.log(2)))
+        self.bits = bytearray((self.m + 7) // 8)
+        self.n = 0
+
+    def _posiciones(self, token: str):
+        h = hashlib.blake2b(token.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(h[:8], "little")
+        h2 = int.from_bytes(h[8:], "little") | 1
+        m = self.m
+        return [(h1 + i * h2) % m for i in range(self.k)]
+
+    def agregar(self, token: str) -> None:
+        bits = self.bits
+        nuevo = False
+        for p in self._posiciones(token):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                nuevo = True
+        if nuevo:   # re-agregar un token (ventana de refresco) no cuenta
+            self.n += 1
+
+    def __contains__(self, token: str) -> bool:
+        bits = self.bits
+        for p in self._posiciones(token):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    @property
+    def lleno(self) -> bool:
+        return self.n > self.capacidad
+
+
+class IndiceTokens:
+    """
+    Filtro de Bloom de scan_events.token, cargado al iniciar y mantenido al día:
+    - la ingesta de este proceso agrega sus tokens al instante (agregar)
+    - un hilo lee cada SCAN_INDEX_REFRESH_SECONDS lo insertado por otros procesos (ingest_xid)
+    Mientras no termina la carga inicial, `estado` es None (se consulta la BD completa).
+    """
+
+    def __init__(self, capacidad: int = SCAN_INDEX_CAPACITY, fp_rate: float = SCAN_INDEX_FP_RATE):
+        self.fp_rate = fp_rate
+        self._lock = threading.Lock()
+        self._filtro = FiltroBloom(capacidad, fp_rate)
+        self._cargando: Optional[FiltroBloom] = None   # filtro en reconstrucción
+        self._marca = 0
+        self.listo = False
+
+    def agregar(self, tokens: Iterable[str]) -> None:
+        tokens = list(tokens)
+        with self._lock:
+            for t in tokens:
+                self._filtro.agregar(t)
+            if self._cargando is not None:
+                for t in tokens:
+                    self._cargando.agregar(t)
+
+    def estado(self) -> Optional[Tuple[FiltroBloom, int]]:
+        """
+        (filtro, marca) consistentes: el filtro tiene todas las filas con ingest_xid < marca
+        (más las de este proceso). None mientras no termina la carga inicial.
+        """
+        with self._lock:
+            if not self.listo:
+                return None
+            return self._filtro, self._marca
+
+    def _leer(self, conn, desde: Optional[int], filtro: FiltroBloom) -> None:
+        """
+        desde=None: todos los tokens. Si no, los de transacciones con txid >= desde.
+        """
+        sql = "SELECT token FROM scan_events"
+        params = {}
+        if desde is not None:
+            sql += " WHERE ingest_xid >= :desde"
+            params["desde"] = desde
+
+        result = conn.execution_options(stream_results=True, yield_per=_LEER_LOTE).execute(text(sql), params)
+        for filas in result.partitions():
+            with self._lock:
+                for (token,) in filas:
+                    filtro.agregar(token)
+
+    def cargar(self) -> None:
+        """
+        Carga completa (cursor del lado del servidor, memoria acotada).
+        Se arma un filtro nuevo aparte; el actual sigue respondiendo hasta el cambio.
+        """
+        with engine.connect() as conn:
+            marca = marca_confirmada(conn)
+            total = conn.execute(text("SELECT COUNT(*) FROM scan_events")).scalar() or 0
+
+            capacidad = max(SCAN_INDEX_CAPACITY, total * 2)
+            filtro = FiltroBloom(capacidad, self.fp_rate)
+
+            with self._lock:
+                self._cargando = filtro
+            try:
+                self._leer(conn, None, filtro)
+            finally:
+                with self._lock:
+                    self._cargando = None
+
+        with self._lock:
+            self._filtro = filtro
+            self._marca = max(self._marca, marca)
+            self.listo = True
+        logger.info("Índice de tokens cargado: %s tokens (capacidad %s)", total, capacidad)
+
+    def refrescar(self) -> None:
+        with engine.connect() as conn:
+            marca = marca_confirmada(conn)
+            self._leer(conn, self._marca, self._filtro)
+
+        with self._lock:
+            self._marca = max(self._marca, marca)
+            lleno = self._filtro.lleno
+
+        # Pasada la capacidad sube la tasa de falsos positivos: reconstruir más grande
+        if lleno:
+            self.cargar()
+
+
+_indice = IndiceTokens()
+_parar = threading.Event()
+_hilo: Optional[threading.Thread] = None
+
+
+def agregar(tokens: Iterable[str]) -> None:
+    if SCAN_INDEX_ENABLED:
+        _indice.agregar(tokens)
+
+
+_EXISTENTES_SQL = text("SELECT token FROM scan_events WHERE token = ANY(:ts)")
+
+# Descartados por el filtro: solo pueden estar entre las filas nuevas (pocas; índice por ingest_xid)
+_EXISTENTES_NUEVOS_SQL = text("""
+    SELECT token FROM scan_events
+    WHERE ingest_xid >= :marca
+      AND token = ANY(:ts)
+""")
+
+
+def existentes(db, tokens: List[str]) -> Set[str]:
+    """
+    Tokens de la lista que están en scan_events (respuesta exacta, también con varios procesos).
+    """
+    if not tokens:
+        return set()
+
+    estado = _indice.estado() if SCAN_INDEX_ENABLED else None
+    if estado is None:
+        return set(db.execute(_EXISTENTES_SQL, {"ts": tokens}).scalars())
+
+    filtro, marca = estado
+    quizas = [t for t in tokens if t in filtro]
+    descartados = [t for t in tokens if t not in filtro]
+
+    out: Set[str] = set()
+    if quizas:
+        out.update(db.execute(_EXISTENTES_SQL, {"ts": quizas}).scalars())
+    if descartados:
+        out.update(db.execute(_EXISTENTES_NUEVOS_SQL, {"marca": marca, "ts": descartados}).scalars())
+    return out
+
+
+def _refresher_loop():
+    while not _parar.is_set():
+        try:
+            if _indice.listo:
+                _indice.refrescar()
+            else:
+                _indice.cargar()
+        except Exception as e:
+            logger.exception("Error actualizando índice de tokens: %s", e)
+        _parar.wait(SCAN_INDEX_REFRESH_SECONDS)
+
+
+def iniciar():
+    """
+    Carga el índice en segundo plano (el arranque no espera) y lo mantiene al día.
+    """
+    global _hilo
+    if not SCAN_INDEX_ENABLED or _hilo is not None:
+        return
+    _parar.clear()
+    _hilo = threading.Thread(target=_refresher_loop, name="scan-index", daemon=True)
+    _hilo.start()
+
+
+def detener():
+    global _hilo
+    _parar.set()
+    _hilo = None
@@ -0,0 +1,411 @@
+import json
+import os
+import hashlib
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from cachetools import TTLCache
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.core.normalizacion import norm_dni
+from app.core.security import verificar_lote
+from app.db.migrations import ROLLUP_COLUMNAS, ROLLUP_SELECT
+from app.db.models import ScanBatch
+from app.services import scan_index
+
+# Scans con firma HMAC inválida: se guardan con sig_ok = false, o se rechazan
+SCAN_REJECT_BAD_SIG = os.getenv("SCAN_REJECT_BAD_SIG", "0") == "1"
+
+# Rol según el id visible del ticket: 001 -> EMPACADOR, AB -> SELECCIONADOR
+KIND_EMPACADOR = "EMPACADOR"
+KIND_SELECCIONADOR = "SELECCIONADOR"
+
+# Uploads por stream (/scans/stream): filas por INSERT
+STREAM_CHUNK_ROWS = int(os.getenv("SCAN_STREAM_CHUNK_ROWS", "2000"))
+
+# Un upload EN_PROCESO sin avance por este tiempo se considera abandonado (se puede retomar)
+STREAM_LEASE_SECONDS = int(os.getenv("SCAN_STREAM_LEASE_SECONDS", "300"))
+
+# Sync offline (/scans/sync): la versión es una marca de ingesta (scan_index.marca_confirmada)
+SYNC_HASH = "blake2b-64"
+
+# Resultados de batches recientes (reintentos de escáneres): evita ir a la BD
+BATCH_CACHE_SIZE = int(os.getenv("SCAN_BATCH_CACHE_SIZE", "4096"))
+BATCH_CACHE_TTL = int(os.getenv("SCAN_BATCH_CACHE_TTL", "900"))  # segundos
+
+# Un solo statement por lote de scans: todas las filas viajan en UN parámetro JSON
+# y Postgres las expande con jsonb_to_recordset (sin un round trip por scan).
+# Lo insertado se suma en scan_rollup en el mismo statement (misma transacción).
+_INSERT_SCANS = text(f"""
+    WITH ins AS (
+    INSERT INTO scan_events (
+        token,
+        dni,
+        user_id,
+        device_id,
+        scanned_at,
+        batch_uuid,
+        session_uuid,
+        raw,
+        lote_id,
+        sig_ok,
+        producto,
+        visible_id,
+        kind
+    )
+    SELECT
+        r.token,
+        r.dni,
+        :user_id,
+        :device_id,
+        r.scanned_at,
+        :batch_uuid,
+        :session_uuid,
+        r.raw,
+        :lote_id,
+        r.sig_ok,
+        r.producto,
+        r.visible_id,
+        r.kind
+    FROM jsonb_to_recordset(CAST(:filas AS jsonb))
+         AS r(token text, dni text, scanned_at timestamptz, raw jsonb, sig_ok boolean,
+              producto text, visible_id text, kind text)
+    ON CONFLICT (token) DO NOTHING
+    RETURNING token, dni, lote_id, producto, user_id, kind, visible_id, scanned_at
+    ),
+    rollup AS (
+        INSERT INTO scan_rollup AS ru {ROLLUP_COLUMNAS}
+        {ROLLUP_SELECT.format(origen="ins")}
+        ON CONFLICT (lote_id, dni, producto, user_id, kind) DO UPDATE
+        SET total = ru.total + EXCLUDED.total,
+            con_id = ru.con_id + EXCLUDED.con_id,
+            ultima_lectura = GREATEST(ru.ultima_lectura, EXCLUDED.ultima_lectura)
+    )
+    SELECT token FROM ins
+""")
+
+
+def clasificar_kind(visible_id: Optional[str]) -> Optional[str]:
+    if not visible_id or not visible_id.isascii():
+        return None
+    if visible_id.isdigit():
+        return KIND_EMPACADOR
+    if visible_id.isalpha():
+        return KIND_SELECCIONADOR
+    return None
+
+
+def preparar_filas(scans: Iterable[Any], shift_label: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Normaliza los scans (ScanItem) a filas para insertar_scans.
+    Descarta los que no traen token o dni.
+    Verifica la firma del payload (raw) de todas las filas en una pasada: sig_ok es
+    False también si el payload es de otro token o de otro DNI.
+    """
+    filas = []
+    for s in scans:
+        token = (s.token or "").strip()
+        dni = norm_dni(s.dni)
+
+        if not token or not dni:
+            continue
+
+        raw = s.raw or {}
+
+        # Guardar shift_label dentro del raw (no altera esquema)
+        if shift_label:
+            raw.setdefault("shift_label", shift_label)
+
+        producto = raw.get("p")
+        visible_id = raw.get("id")
+        visible_id = str(visible_id) if visible_id is not None else None
+
+        filas.append({
+            "token": token,
+            "dni": dni,
+            "scanned_at": s.scanned_at.isoformat(),
+            "raw": raw or None,
+            "producto": str(producto) if producto is not None else None,
+            "visible_id": visible_id,
+            "kind": clasificar_kind(visible_id),
+        })
+
+    for f, ok in zip(filas, verificar_lote(f["raw"] for f in filas)):
+        if ok:
+            raw = f["raw"]
+            ok = raw.get("t") == f["token"] and norm_dni(raw.get("dni")) == f["dni"]
+        f["sig_ok"] = ok
+    return filas
+
+
+def filtrar_firmas(
+    filas: List[Dict[str, Any]], rechazar: Optional[bool] = None
+) -> Tuple[List[Dict[str, Any]], int, int]:
+    """
+    (filas a insertar, nº con firma inválida, nº rechazadas).
+    Solo se rechazan firmas inválidas (sig_ok False), nunca las filas sin payload.
+    """
+    rechazar = SCAN_REJECT_BAD_SIG if rechazar is None else rechazar
+    invalidas = sum(1 for f in filas if f["sig_ok"] is False)
+    if not rechazar or not invalidas:
+        return filas, invalidas, 0
+    return [f for f in filas if f["sig_ok"] is not False], invalidas, invalidas
+
+
+def insertar_scans(
+    db,
+    filas: List[Dict[str, Any]],
+    *,
+    lote_id: int,
+    user_id: str,
+    device_id: Optional[str],
+    batch_uuid: str,
+    session_uuid: Optional[str],
+) -> List[str]:
+    """
+    Inserta todas las filas con un solo statement (ON CONFLICT (token) DO NOTHING).
+    Retorna los tokens aceptados. No hace commit.
+    """
+    if not filas:
+        return []
+
+    aceptados = db.execute(
+        _INSERT_SCANS,
+        {
+            "filas": json.dumps(filas, separators=(",", ":"), ensure_ascii=False),
+            "user_id": user_id,
+            "device_id": device_id,
+            "batch_uuid": batch_uuid,
+            "session_uuid": session_uuid,
+            "lote_id": lote_id,
+        },
+    ).scalars().all()
+
+    # Índice de /scans/exists: agregar antes del commit es seguro (a lo sumo un "quizás" de más)
+    scan_index.agregar(aceptados)
+    return aceptados
+
+
+def duplicados(filas: List[Dict[str, Any]], aceptados: Iterable[str]) -> List[str]:
+    """
+    Tokens de `filas` que no entraron (ya existían o venían repetidos en el lote).
+    """
+    pendientes = set(aceptados)
+    dups = []
+    for f in filas:
+        token = f["token"]
+        if token in pendientes:
+            pendientes.discard(token)   # la primera aparición es la aceptada
+        else:
+            dups.append(token)
+    return dups
+
+
+# ==========================================================
+# BATCHES PROCESADOS (idempotencia por batch_uuid)
+# ==========================================================
+_batches_cache: "TTLCache[str, Dict[str, Any]]" = TTLCache(maxsize=BATCH_CACHE_SIZE, ttl=BATCH_CACHE_TTL)
+_batches_lock = threading.Lock()
+
+
+def _resultado(b: ScanBatch) -> Dict[str, Any]:
+    return {
+        "accepted_count": b.accepted_count,
+        "duplicate_count": b.duplicate_count,
+        "invalid_sig_count": b.invalid_sig_count or 0,
+        "rejected_count": b.rejected_count or 0,
+        "duplicates": list(b.duplicates or []),
+    }
+
+
+def batch_procesado(db, batch_uuid: str) -> Optional[Dict[str, Any]]:
+    """
+    Resultado guardado de un batch ya terminado (None si es nuevo o un stream a medias).
+    Primero el cache en memoria, luego una lectura por PK en scan_batches.
+    """
+    with _batches_lock:
+        hit = _batches_cache.get(batch_uuid)
+    if hit is not None:
+        return hit
+
+    b = db.get(ScanBatch, batch_uuid)
+    if b is None or b.terminado_en is None:
+        return None
+
+    res = _resultado(b)
+    with _batches_lock:
+        _batches_cache[batch_uuid] = res
+    return res
+
+
+def reservar_batch(db, batch_uuid: str, *, lote_id: int, user_id: str, device_id: Optional[str]) -> bool:
+    """
+    Registra el batch en scan_batches dentro de la transacción actual.
+    False si otro request ya lo registró (el INSERT espera a que ese termine).
+    """
+    r = db.execute(
+        pg_insert(ScanBatch)
+        .values(
+            batch_uuid=batch_uuid,
+            lote_id=lote_id,
+            user_id=user_id,
+            device_id=device_id,
+            creado_en=datetime.utcnow(),
+        )
+        .on_conflict_do_nothing(index_elements=[ScanBatch.batch_uuid])
+        .returning(ScanBatch.batch_uuid)
+    ).first()
+    return r is not None
+
+
+def cerrar_batch(
+    db,
+    batch_uuid: str,
+    *,
+    scan_count: int,
+    aceptados: int,
+    dups: Optional[List[str]],
+    firmas_invalidas: int = 0,
+    rechazados: int = 0,
+) -> Dict[str, Any]:
+    """
+    Guarda el resultado del batch (misma transacción que los scans). No hace commit.
+    dups=None: no se guarda la lista (uploads por stream, pueden ser enormes).
+    """
+    b = db.get(ScanBatch, batch_uuid)
+    b.scan_count = scan_count
+    b.accepted_count = aceptados
+    b.duplicate_count = scan_count - aceptados - rechazados
+    b.invalid_sig_count = firmas_invalidas
+    b.rejected_count = rechazados
+    b.duplicates = dups
+    b.estado = "COMPLETADO"
+    b.error = None
+    b.terminado_en = b.actualizado_en = datetime.utcnow()
+    return _resultado(b)
+
+
+def recordar_batch(batch_uuid: str, res: Dict[str, Any]) -> None:
+    """
+    Cachea el resultado una vez hecho el commit.
+    """
+    with _batches_lock:
+        _batches_cache[batch_uuid] = res
+
+
+# ==========================================================
+# AVANCE DE UPLOADS POR STREAM (scan_batches)
+# ==========================================================
+_AVANCE_CAMPOS = ("lineas", "scan_count", "accepted_count", "invalid_sig_count", "rejected_count", "chunks")
+
+
+def tomar_stream(db, batch_uuid: str, *, lote_id: int, user_id: str, device_id: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Registra (o retoma) el upload en scan_batches como EN_PROCESO, dentro de la transacción actual.
+    Retorna el avance ya confirmado ({lineas, scan_count, ...}; todo en 0 si es nuevo),
+    o None si ya terminó o lo está procesando otro request (EN_PROCESO con avance reciente).
+    """
+    ahora = datetime.utcnow()
+    stmt = pg_insert(ScanBatch).values(
+        batch_uuid=batch_uuid,
+        lote_id=lote_id,
+        user_id=user_id,
+        device_id=device_id,
+        estado="EN_PROCESO",
+        creado_en=ahora,
+        actualizado_en=ahora,
+        **{c: 0 for c in _AVANCE_CAMPOS},
+    )
+    r = db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[ScanBatch.batch_uuid],
+            set_={"estado": "EN_PROCESO", "error": None, "actualizado_en": ahora},
+            where=ScanBatch.terminado_en.is_(None) & (
+                (ScanBatch.estado != "EN_PROCESO")
+                | (ScanBatch.actualizado_en < ahora - timedelta(seconds=STREAM_LEASE_SECONDS))
+            ),
+        ).returning(*(getattr(ScanBatch, c) for c in _AVANCE_CAMPOS))
+    ).first()
+    if r is None:
+        return None
+    return {c: v or 0 for c, v in zip(_AVANCE_CAMPOS, r)}
+
+
+def avance_stream(db, batch_uuid: str, **avance) -> None:
+    """
+    Guarda el avance del upload. Misma transacción que el chunk insertado: las líneas
+    registradas son exactamente las que ya están en scan_events. No hace commit.
+    """
+    b = db.get(ScanBatch, batch_uuid)
+    for campo, valor in avance.items():
+        setattr(b, campo, valor)
+    b.actualizado_en = datetime.utcnow()
+
+
+def fallar_stream(db, batch_uuid: str, error: str) -> None:
+    """
+    Marca el upload como ERROR (lo confirmado hasta ahí se conserva; un reintento lo retoma).
+    """
+    b = db.get(ScanBatch, batch_uuid)
+    if b is not None and b.terminado_en is None:
+        b.estado = "ERROR"
+        b.error = error[:1000]
+        b.actualizado_en = datetime.utcnow()
+        db.commit()
+
+
+def progreso_stream(db, batch_uuid: str) -> Optional[Dict[str, Any]]:
+    b = db.get(ScanBatch, batch_uuid)
+    if b is None:
+        return None
+    p = {c: getattr(b, c) or 0 for c in _AVANCE_CAMPOS}
+    p.update(
+        estado=b.estado or "COMPLETADO",
+        duplicate_count=b.duplicate_count or 0,
+        error=b.error,
+        iniciado_en=b.creado_en.isoformat() if b.creado_en else None,
+        actualizado_en=b.actualizado_en.isoformat() if b.actualizado_en else None,
+        terminado_en=b.terminado_en.isoformat() if b.terminado_en else None,
+    )
+    return p
+
+
+# ==========================================================
+# SYNC OFFLINE (tokens escaneados por lote)
+# ==========================================================
+def hash_token(token: str) -> int:
+    """
+    Hash de 64 bits del token (blake2b, big-endian): lo que recibe el escáner.
+    """
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def sync_lote(db, lote_id: int, desde: int = 0) -> Dict[str, Any]:
+    """
+    Tokens del lote como arreglo ordenado de hashes uint64 big-endian
+    (el escáner busca con búsqueda binaria y une las deltas).
+
+    desde=0: snapshot completo. desde>0: delta con las filas de transacciones
+    con txid >= desde. La versión se toma antes de leer: una fila confirmada
+    tarde entra en la delta siguiente (puede repetirse; unir dos veces el
+    mismo hash no cambia nada).
+    """
+    version = scan_index.marca_confirmada(db)
+
+    sql = "SELECT token FROM scan_events WHERE lote_id = :l"
+    params = {"l": lote_id}
+    if desde:
+        sql += " AND ingest_xid >= :d"
+        params["d"] = desde
+    rows = db.execute(text(sql), params).all()
+
+    hashes = np.unique(np.fromiter((hash_token(r.token) for r in rows), dtype=np.uint64, count=len(rows)))
+
+    return {
+        "version": version,
+        "count": len(hashes),
+        "data": hashes.astype(">u8").tobytes(),
+    }
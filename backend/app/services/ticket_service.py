@@ -0,0 +1,64 @@
+from typing import Any, Dict, List
+
+from sqlalchemy import insert
+
+from app.core.security import firmar_lote, payload_qr
+from app.core.tokens import reservar_tokens
+from app.db.models import QREmitido
+
+
+def emitir_tickets(
+    db,
+    *,
+    dni: str,
+    nn: str,
+    producto: str,
+    usuario: str,
+    cantidad: int,
+) -> List[Dict[str, Any]]:
+    """
+    Emite `cantidad` tickets de una sola vez:
+    - reserva todos los tokens por adelantado (bloques de la secuencia, sin colisiones)
+    - los guarda con UN solo INSERT multi-fila en qr_emitidos (sin flush por ticket)
+    - firma cada ticket
+
+    No hace commit: la transacción la controla quien llama.
+    Retorna los items listos para ZPL, en orden de impresión.
+    """
+    tokens = reservar_tokens(db, producto, cantidad)
+
+    # 1) Un solo INSERT ... VALUES (...), (...), ...
+    db.execute(
+        insert(QREmitido).values([
+            {
+                "token": token,
+                "dni_trabajador": dni,
+                "nn": nn,
+                "producto": producto,
+                "impreso_por": usuario,
+            }
+            for token in tokens
+        ])
+    )
+
+    # 2) Items para ZPL (firmados en lote)
+    return items_tickets(tokens, dni=dni, nn=nn, producto=producto)
+
+
+def items_tickets(tokens: List[str], *, dni: str, nn: str, producto: str) -> List[Dict[str, Any]]:
+    """
+    Firma los tokens en lote y arma, una sola vez por ticket, el payload del QR
+    ("data": JSON canónico de core.security.payload_qr).
+    """
+    firmas = firmar_lote((token, dni, nn, producto) for token in tokens)
+    return [
+        {
+            "token": token,
+            "dni": dni,
+            "visible": nn,
+            "producto": producto,
+            "sig": sig,
+            "data": payload_qr(token, dni, nn, producto, sig),
+        }
+        for token, sig in zip(tokens, firmas)
+    ]
@@ -1,158 +1,328 @@
 import json
-import qrcode
-from app.core.security import sign
-
-def generar_zpl_qr( token: str, dni: str, visible: str, producto: str,):
-    
-    # --------------------------------------------------
-    # Payload QR
-    # --------------------------------------------------
-    base = f"{token}|{dni}|{visible}|{producto}|1"
-
-    payload = {
-        "t": token,
-        "dni": dni,
-        "id": visible,
-        "p": producto,
-        "v": 1,
-        "sig": sign(base)
-    }
-
-    qr_data = json.dumps(payload, separators=(",", ":"))
-
-    # --------------------------------------------------
-    # ZPL
-    # --------------------------------------------------
-    zpl = f"""
-        ^XA
-        ^PW199
-        ^LL199
-
-        ^FO0,2
-        ^BQN,2,3
-        ^FDHA,{qr_data}^FS
-
-        ^FO55,71
-        ^GB70,40,40,W,0^FS
-
-        ^FO68,80
-        ^A0N,30,30
-        ^FD{visible}^FS
-
-        ^XZ
-        """
-    return zpl.strip()
+import hashlib
+from functools import lru_cache
+
+from app.core.security import payload_qr
 
 def _mm_to_dots(mm: float, dpi: int = 203) -> int:
     return int(round(mm * dpi / 25.4))
 
+# Codewords de datos por versión (1..40) con ECC nivel H (ISO/IEC 18004, tabla 7)
+_QR_DATA_CODEWORDS_H = (
+    9, 16, 26, 36, 46, 60, 66, 86, 100, 122,
+    140, 158, 180, 197, 223, 253, 283, 313, 341, 385,
+    406, 442, 464, 514, 538, 596, 628, 661, 701, 745,
+    793, 845, 901, 961, 986, 1054, 1096, 1142, 1222, 1276,
+)
+
+_QR_ALFANUM = frozenset("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ $%*+-./:")
+
+
+def _qr_modo(data: str) -> str:
+    if data.isascii() and data.isdigit():
+        return "num"
+    if all(c in _QR_ALFANUM for c in data):
+        return "alnum"
+    return "byte"
+
+
+@lru_cache(maxsize=1024)
+def _qr_version_H(n: int, modo: str) -> int:
+    """
+    Versión mínima de QR (ECC H) para n caracteres/bytes en un solo segmento.
+    Mismo cálculo que qrcode.make(fit=True), pero solo con la tabla de capacidad.
+    """
+    if modo == "num":
+        bits_datos = 10 * (n // 3) + (0, 4, 7)[n % 3]
+        bits_cci = (10, 12, 14)
+    elif modo == "alnum":
+        bits_datos = 11 * (n // 2) + 6 * (n % 2)
+        bits_cci = (9, 11, 13)
+    else:
+        bits_datos = 8 * n
+        bits_cci = (8, 16, 16)
+
+    for version, codewords in enumerate(_QR_DATA_CODEWORDS_H, start=1):
+        rango = 0 if version < 10 else (1 if version < 27 else 2)
+        if 4 + bits_cci[rango] + bits_datos <= codewords * 8:
+            return version
+
+    raise ValueError(f"Payload demasiado grande para QR ECC H ({n} {modo})")
+
+
 def _qr_modules_count_H(data: str) -> int:
-    qr = qrcode.QRCode(
-        version=None,
-        error_correction=qrcode.constants.ERROR_CORRECT_H,
-        box_size=1,
-        border=4,
+    modo = _qr_modo(data)
+    n = len(data) if modo != "byte" else len(data.encode("utf-8"))
+    return 17 + 4 * _qr_version_H(n, modo)
+
+# --------------------------------------------------
+# Plantillas ZPL multi-columna (compiladas una vez)
+# --------------------------------------------------
+# Layout base probado (mag=3, 1-col):
+# QR:  ^FO0,2 ^BQN,2,3
+# BOX: ^FO55,71 ^GB70,40,40
+# TXT: ^FO68,80 ^A0N,30,30
+_BASE_MAG = 3
+_BASE_BOX_X = 55
+_BASE_BOX_Y = 71
+_BASE_BOX_W = 70
+_BASE_BOX_H = 40
+_BASE_FONT = 30
+
+# Coordenada Y del QR dentro de cada etiqueta
+_QR_Y = 15
+
+
+class PlantillaZPL:
+    """
+    Layout compilado para (dpi, label_mm, gap_mm, margin_mm, mag, columnas).
+
+    cabecera/pie: texto fijo de la fila (^XA ... / ^XZ)
+    celdas[i]:    (antes_qr, antes_texto, fin) de la columna i; por etiqueta solo
+                  se insertan dos slots: datos del QR y texto visible.
+
+    Formato almacenado (^DF/^XF) del mismo layout:
+    formato_nombre: nombre en la impresora (hash del contenido = versión)
+    formato_zpl:    ^DF que descarga el layout a la impresora (una vez por sesión)
+    recall_cab:     ^XA ... ^XF que recupera el formato
+    recall_celdas[i]: (antes_qr, antes_texto, fin) con ^FN en vez de posiciones
+    """
+    __slots__ = (
+        "columnas", "label_w", "margin", "cabecera", "celdas", "pie",
+        "formato_nombre", "formato_zpl", "recall_cab", "recall_celdas",
     )
-    qr.add_data(data)
-    qr.make(fit=True)
-    return qr.modules_count
 
-def generar_zpl_qr_4cols(
-    items,
+    def __init__(self, columnas, label_w, margin, cabecera, celdas, pie,
+                 formato_nombre, formato_zpl, recall_cab, recall_celdas):
+        self.columnas = columnas
+        self.label_w = label_w
+        self.margin = margin
+        self.cabecera = cabecera
+        self.celdas = celdas
+        self.pie = pie
+        self.formato_nombre = formato_nombre
+        self.formato_zpl = formato_zpl
+        self.recall_cab = recall_cab
+        self.recall_celdas = recall_celdas
+
+
+@lru_cache(maxsize=256)
+def compilar_plantilla(
     dpi: int = 203,
     label_mm: float = 25.0,
     gap_mm: float = 1.0,
     margin_mm: float = 1.0,
-    qr_mag: int = 3,   # 👈 empieza con 3 (como tu 1-col)
-):
+    mag: int = 3,
+    columnas: int = 4,
+) -> PlantillaZPL:
     # Medidas físicas
     label_w = _mm_to_dots(label_mm, dpi)   # ~200
     label_h = _mm_to_dots(label_mm, dpi)   # ~200
     gap = _mm_to_dots(gap_mm, dpi)
     margin = _mm_to_dots(margin_mm, dpi)
 
-    total_w = (label_w * 4) + (gap * 3) + (margin * 2)
+    total_w = (label_w * columnas) + (gap * (columnas - 1)) + (margin * 2)
     total_h = label_h
 
-    # Coordenada de inicio del QR dentro de cada etiqueta (igual a 1-col: ^FO0,2)
-    qr_y = 15
-
-    # Layout base (tu etiqueta que sí funciona) para mag=3:
-    # QR: ^FO0,2 ^BQN,2,3
-    # BOX: ^FO55,71 ^GB70,40,40
-    # TXT: ^FO68,80 ^A0N,30,30
-    base_mag = 3
-    base_box_x = 55
-    base_box_y = 71
-    base_box_w = 70
-    base_box_h = 40
-    base_font = 30
-
-    zpl = []
-    zpl.append("^XA")
-    zpl.append("^CI28")
-    zpl.append(f"^PW{total_w}")
-    zpl.append(f"^LL{total_h}")
-    zpl.append("^LH0,0")
-
-    cols = list(items[:4]) + [None] * (4 - len(items))
-
-    for i, it in enumerate(cols):
+    config = "\n".join([
+        "^CI28",
+        f"^PW{total_w}",
+        f"^LL{total_h}",
+        "^LH0,0",
+    ]) + "\n"
+    cabecera = "^XA\n" + config
+
+    # Escalar el layout probado según magnificación
+    scale = mag / _BASE_MAG
+    box_w = int(round(_BASE_BOX_W * scale))
+    box_h = int(round(_BASE_BOX_H * scale))
+    font = int(round(_BASE_FONT * scale))
+
+    celdas = []
+    cuerpo_formato = []
+    recall_celdas = []
+    for i in range(columnas):
         x0 = margin + i * (label_w + gap)
-        if not it:
-            continue
 
-        payload = it.get("payload")
-        if payload is None:
-            payload = {
-                "t": it["token"],
-                "dni": it["dni"],
-                "id": it["visible"],
-                "p": it["producto"],
-                "v": 1,
-                "sig": it["sig"],
-            }
-
-        data = json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
-
-        # 1) Elegir magnificación que NO recorte el QR en 25x25
-        modules = _qr_modules_count_H(data)
-        # tamaño en módulos incluyendo quiet zone: (modules + 8)
-        max_mag = (label_w - 2 * margin) // (modules + 8)
-        mag = min(qr_mag, int(max_mag))
-        if mag < 2:
-            mag = 2  # mínimo razonable
-
-        # 2) Imprimir QR con ECC H (CRÍTICO)
-        zpl.append(f"^FO{x0},{qr_y}")
-        zpl.append(f"^BQN,2,{mag}")
-        zpl.append(f"^FDHA,{data}^FS")   # 👈 HA (H)
-
-        # 3) Escalar tu layout probado según magnificación
-        scale = mag / base_mag
-
-        box_x = x0 + int(round(base_box_x * scale))
-        box_y = qr_y + int(round((base_box_y - qr_y) * scale))  # relativo al QR
-        box_w = int(round(base_box_w * scale))
-        box_h = int(round(base_box_h * scale))
-        font  = int(round(base_font  * scale))
+        box_x = x0 + int(round(_BASE_BOX_X * scale))
+        box_y = _QR_Y + int(round((_BASE_BOX_Y - _QR_Y) * scale))  # relativo al QR
 
         # clamp (para que no se salga de la celda)
         box_x = max(x0, min(box_x, x0 + label_w - box_w))
-        box_y = max(0,  min(box_y,       label_h - box_h))
+        box_y = max(0, min(box_y, label_h - box_h))
+
+        # Texto centrado dentro del rectángulo
+        f = max(18, min(font, box_h - 6))
+        text_y = box_y + max(0, (box_h - f) // 2)
+
+        qr_cmd = f"^FO{x0},{_QR_Y}\n^BQN,2,{mag}"
+        texto_cmd = "\n".join([
+            f"^FO{box_x},{box_y}",
+            f"^GB{box_w},{box_h},{box_h},W,0^FS",                # rectángulo blanco relleno
+            f"^FO{box_x},{text_y}",
+            f"^A0N,{f},{f}",
+            f"^FB{box_w},1,0,C,0",
+        ])
+
+        celdas.append((
+            qr_cmd + "\n^FDHA,",                                  # QR con ECC H
+            "^FS\n" + texto_cmd + "\n^FD",
+            "^FS\n",
+        ))
+
+        fn_qr, fn_txt = 2 * i + 1, 2 * i + 2
+        cuerpo_formato.append(f"{qr_cmd}\n^FN{fn_qr}^FS\n{texto_cmd}\n^FN{fn_txt}^FS\n")
+        recall_celdas.append((f"^FN{fn_qr}^FDHA,", f"^FS\n^FN{fn_txt}^FD", "^FS\n"))
+
+    # Nombre = hash del layout: si el layout cambia, cambia la "versión" del formato
+    cuerpo = config + "".join(cuerpo_formato)
+    formato_nombre = "QF" + hashlib.sha1(cuerpo.encode("utf-8")).hexdigest()[:6].upper()
+    ruta = f"R:{formato_nombre}.ZPL"
+
+    return PlantillaZPL(
+        columnas, label_w, margin, cabecera, tuple(celdas), "^XZ",
+        formato_nombre,
+        f"^XA\n^DF{ruta}^FS\n{cuerpo}^XZ",
+        f"^XA\n^CI28\n^XF{ruta}\n",
+        tuple(recall_celdas),
+    )
+
+
+@lru_cache(maxsize=1024)
+def _mag_efectiva(modules: int, label_w: int, margin: int, qr_mag: int) -> int:
+    # tamaño en módulos incluyendo quiet zone: (modules + 8)
+    max_mag = (label_w - 2 * margin) // (modules + 8)
+    return max(2, min(qr_mag, int(max_mag)))  # mínimo razonable: 2
+
+
+def _qr_data(it) -> str:
+    # payload ya serializado (ticket_service.items_tickets): no se vuelve a armar
+    data = it.get("data")
+    if data is not None:
+        return data
+
+    payload = it.get("payload")
+    if payload is not None:
+        return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+    return payload_qr(it["token"], it["dni"], it["visible"], it["producto"], it["sig"])
+
+
+def generar_zpl_qr_cols(
+    items,
+    columnas: int = 4,
+    dpi: int = 203,
+    label_mm: float = 25.0,
+    gap_mm: float = 1.0,
+    margin_mm: float = 1.0,
+    qr_mag: int = 3,
+):
+    """
+    Una fila ZPL de `columnas` etiquetas (stock de 1, 2, 3, 4... columnas).
+    El layout sale de compilar_plantilla (cacheado); por etiqueta solo se elige
+    la magnificación que NO recorte el QR y se rellenan los slots.
+    """
+    base = compilar_plantilla(dpi, label_mm, gap_mm, margin_mm, qr_mag, columnas)
+
+    partes = [base.cabecera]
+    for i, it in enumerate(items[:columnas]):
+        if not it:
+            continue
+
+        data = _qr_data(it)
+        mag = _mag_efectiva(_qr_modules_count_H(data), base.label_w, base.margin, qr_mag)
+        plantilla = base if mag == qr_mag else compilar_plantilla(
+            dpi, label_mm, gap_mm, margin_mm, mag, columnas
+        )
+
+        antes_qr, antes_texto, fin = plantilla.celdas[i]
+        partes += (antes_qr, data, antes_texto, it["visible"], fin)
+
+    partes.append(base.pie)
+    return "".join(partes)
+
+
+def generar_zpl_recall_cols(
+    items,
+    columnas: int = 4,
+    dpi: int = 203,
+    label_mm: float = 25.0,
+    gap_mm: float = 1.0,
+    margin_mm: float = 1.0,
+    qr_mag: int = 3,
+):
+    """
+    Igual que generar_zpl_qr_cols, pero usando el formato almacenado (^XF + ^FN).
+    La fila usa una sola magnificación (la menor que necesite alguna etiqueta).
+
+    Retorna (plantilla, zpl). plantilla.formato_nombre / formato_zpl indican qué
+    formato debe estar descargado en la impresora antes de imprimir la fila.
+    """
+    items = [it for it in items[:columnas]]
+    datos = [_qr_data(it) if it else None for it in items]
+
+    base = compilar_plantilla(dpi, label_mm, gap_mm, margin_mm, qr_mag, columnas)
+    mag = min(
+        [_mag_efectiva(_qr_modules_count_H(d), base.label_w, base.margin, qr_mag) for d in datos if d]
+        or [qr_mag]
+    )
+    plantilla = base if mag == qr_mag else compilar_plantilla(
+        dpi, label_mm, gap_mm, margin_mm, mag, columnas
+    )
+
+    partes = [plantilla.recall_cab]
+    for i, (it, data) in enumerate(zip(items, datos)):
+        if not it:
+            continue
+        antes_qr, antes_texto, fin = plantilla.recall_celdas[i]
+        partes += (antes_qr, data, antes_texto, it["visible"], fin)
+
+    partes.append(plantilla.pie)
+    return plantilla, "".join(partes)
+
+
+def generar_zpl_qr_4cols(
+    items,
+    dpi: int = 203,
+    label_mm: float = 25.0,
+    gap_mm: float = 1.0,
+    margin_mm: float = 1.0,
+    qr_mag: int = 3,   # 👈 empieza con 3 (como tu 1-col)
+):
+    return generar_zpl_qr_cols(
+        items,
+        columnas=4,
+        dpi=dpi,
+        label_mm=label_mm,
+        gap_mm=gap_mm,
+        margin_mm=margin_mm,
+        qr_mag=qr_mag,
+    )
+
+
+def generar_zpl_lote(filas, **kwargs) -> str:
+    """
+    Combina varias filas (cada una = lista de hasta 4 items) en un solo payload ZPL.
+    Cada fila sigue siendo su propio ^XA...^XZ, así que la impresora las imprime
+    en orden, pero el agente las recibe como UN job (1 POST, 1 conexión).
 
-        # 4) Rectángulo blanco relleno (thickness=box_h)
-        zpl.append(f"^FO{box_x},{box_y}")
-        zpl.append(f"^GB{box_w},{box_h},{box_h},W,0^FS")
+    kwargs se pasan tal cual a generar_zpl_qr_cols (columnas, dpi, qr_mag, ...).
+    """
+    return "\n".join(generar_zpl_qr_cols(items, **kwargs) for items in filas)
 
-        # 5) Texto centrado dentro del rectángulo
-        font = max(18, min(font, box_h - 6))
-        text_y = box_y + max(0, (box_h - font) // 2)
 
-        zpl.append(f"^FO{box_x},{text_y}")
-        zpl.append(f"^A0N,{font},{font}")
-        zpl.append(f"^FB{box_w},1,0,C,0")
-        zpl.append(f"^FD{it['visible']}^FS")
+def generar_zpl_lote_formato(filas, **kwargs):
+    """
+    Versión con formato almacenado de generar_zpl_lote.
 
-    zpl.append("^XZ")
-    return "\n".join(zpl)
+    Retorna (formatos, zpl):
+    - formatos: {nombre: zpl ^DF} que la impresora debe tener descargados
+    - zpl: filas ^XF...^XZ concatenadas (solo datos variables)
+    """
+    formatos = {}
+    partes = []
+    for items in filas:
+        plantilla, zpl = generar_zpl_recall_cols(items, **kwargs)
+        formatos[plantilla.formato_nombre] = plantilla.formato_zpl
+        partes.append(zpl)
+    return formatos, "\n".join(partes)
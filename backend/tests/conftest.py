@@ -0,0 +1,5 @@
+import os
+import sys
+
+# los tests importan el paquete "app" desde backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
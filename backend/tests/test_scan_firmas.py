@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api import routes_scans
+from app.core.auth_dep import get_current_user
+from app.core.security import payload_qr, verificar_lote
+from app.services import scan_service
+
+
+class _SesionFalsa:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def _cliente(monkeypatch, insertadas):
+    monkeypatch.setattr(routes_scans, "SessionLocal", _SesionFalsa)
+    monkeypatch.setattr(routes_scans, "_lote_abierto", lambda db, c, u: SimpleNamespace(id=1))
+    monkeypatch.setattr(scan_service, "batch_procesado", lambda db, b: None)
+    monkeypatch.setattr(scan_service, "reservar_batch", lambda db, b, **kw: True)
+    monkeypatch.setattr(scan_service, "recordar_batch", lambda b, res: None)
+
+    def insertar(db, filas, **kw):
+        insertadas.extend(filas)
+        return [f["token"] for f in filas]
+
+    def cerrar(db, b, *, scan_count, aceptados, dups, firmas_invalidas, rechazados):
+        return {
+            "accepted_count": aceptados,
+            "duplicate_count": len(dups),
+            "duplicates": dups,
+            "invalid_sig_count": firmas_invalidas,
+            "rejected_count": rechazados,
+        }
+
+    monkeypatch.setattr(scan_service, "insertar_scans", insertar)
+    monkeypatch.setattr(scan_service, "cerrar_batch", cerrar)
+
+    app = FastAPI()
+    app.include_router(routes_scans.router)
+    app.dependency_overrides[get_current_user] = lambda: {"usuario": "op1"}
+    return TestClient(app)
+
+
+def test_firma_no_ascii_es_invalida():
+    raw = {"t": "T1", "dni": "12345678", "id": "001", "p": "UVA", "v": 1, "sig": "ñandú✓"}
+    assert verificar_lote([raw]) == [False]
+
+
+def test_batch_con_firma_no_ascii(monkeypatch):
+    import json
+
+    valido = json.loads(payload_qr("T1", "12345678", "001", "UVA"))
+    adulterado = dict(valido, t="T2", sig="ñandú✓")
+
+    insertadas = []
+    r = _cliente(monkeypatch, insertadas).post(
+        "/scans/batch",
+        json={
+            "batch_uuid": "b-1",
+            "lote_codigo": "L1",
+            "scans": [
+                {"token": "T1", "dni": "12345678", "scanned_at": "2026-10-18T10:00:00", "raw": valido},
+                {"token": "T2", "dni": "12345678", "scanned_at": "2026-10-18T10:00:01", "raw": adulterado},
+            ],
+        },
+    )
+
+    assert r.status_code == 200
+    assert r.json()["invalid_sig_count"] == 1
+    assert {f["token"]: f["sig_ok"] for f in insertadas} == {"T1": True, "T2": False}
@@ -0,0 +1,34 @@
+from app.services import scan_index
+
+
+class _BDFalsa:
+    """
+    scan_events como {token: ingest_xid}; ejecuta las dos consultas de scan_index.existentes.
+    """
+
+    def __init__(self, filas):
+        self.filas = filas
+        self.consultas = []
+
+    def execute(self, sql, params):
+        self.consultas.append(params)
+        ts = [t for t in params["ts"] if t in self.filas]
+        if "marca" in params:
+            ts = [t for t in ts if self.filas[t] >= params["marca"]]
+        return type("R", (), {"scalars": lambda _self: iter(ts)})()
+
+
+def test_existentes_ve_inserts_de_otro_proceso(monkeypatch):
+    indice = scan_index.IndiceTokens(capacidad=1000, fp_rate=0.001)
+    indice.agregar(["A", "B"])
+    indice._marca = 100
+    indice.listo = True
+    monkeypatch.setattr(scan_index, "_indice", indice)
+    monkeypatch.setattr(scan_index, "SCAN_INDEX_ENABLED", True)
+
+    # C lo insertó otro proceso después del último refresco: no está en el filtro
+    db = _BDFalsa({"A": 10, "B": 50, "C": 120})
+
+    assert scan_index.existentes(db, ["A", "C", "Z"]) == {"A", "C"}
+    # los descartados solo se buscan entre las filas nuevas
+    assert {"marca": 100, "ts": ["C", "Z"]} in db.consultas
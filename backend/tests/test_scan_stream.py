@@ -0,0 +1,100 @@
+import json
+from types import SimpleNamespace
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api import routes_scans
+from app.core.auth_dep import get_current_user
+from app.services import scan_service
+
+
+class _SesionFalsa:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def _ledger_falso(monkeypatch):
+    """
+    scan_batches en un dict: el avance se guarda con cada chunk, como en la BD.
+    """
+    ledger = {}
+    insertados = []
+
+    def tomar(db, b, **kw):
+        fila = ledger.setdefault(b, {c: 0 for c in scan_service._AVANCE_CAMPOS})
+        if fila.get("estado") == "COMPLETADO":
+            return None
+        fila["estado"] = "EN_PROCESO"
+        return {c: fila[c] for c in scan_service._AVANCE_CAMPOS}
+
+    def avance(db, b, **campos):
+        ledger[b].update(campos)
+
+    def fallar(db, b, error):
+        ledger[b].update(estado="ERROR", error=error)
+
+    def cerrar(db, b, *, scan_count, aceptados, dups, firmas_invalidas, rechazados):
+        ledger[b].update(estado="COMPLETADO", scan_count=scan_count, accepted_count=aceptados)
+        return {"accepted_count": aceptados, "duplicate_count": scan_count - aceptados - rechazados,
+                "invalid_sig_count": firmas_invalidas, "rejected_count": rechazados, "duplicates": []}
+
+    def insertar(db, filas, **kw):
+        nuevos = [f["token"] for f in filas if f["token"] not in insertados]
+        insertados.extend(nuevos)
+        return nuevos
+
+    monkeypatch.setattr(routes_scans, "SessionLocal", _SesionFalsa)
+    monkeypatch.setattr(routes_scans, "_lote_abierto", lambda db, c, u: SimpleNamespace(id=1))
+    monkeypatch.setattr(scan_service, "batch_procesado", lambda db, b: None)
+    monkeypatch.setattr(scan_service, "recordar_batch", lambda b, res: None)
+    monkeypatch.setattr(scan_service, "tomar_stream", tomar)
+    monkeypatch.setattr(scan_service, "avance_stream", avance)
+    monkeypatch.setattr(scan_service, "fallar_stream", fallar)
+    monkeypatch.setattr(scan_service, "cerrar_batch", cerrar)
+    monkeypatch.setattr(scan_service, "insertar_scans", insertar)
+    monkeypatch.setattr(scan_service, "STREAM_CHUNK_ROWS", 2)
+    return ledger, insertados
+
+
+def _ndjson(n, mala=None):
+    lineas = []
+    for i in range(1, n + 1):
+        if i == mala:
+            lineas.append("{no es json")
+        else:
+            lineas.append(json.dumps({"token": f"T{i}", "dni": "12345678", "scanned_at": "2026-10-18T10:00:00"}))
+    return ("\n".join(lineas) + "\n").encode()
+
+
+def test_stream_cortado_se_retoma(monkeypatch):
+    ledger, insertados = _ledger_falso(monkeypatch)
+    app = FastAPI()
+    app.include_router(routes_scans.router)
+    app.dependency_overrides[get_current_user] = lambda: {"usuario": "op1"}
+    c = TestClient(app)
+    params = {"batch_uuid": "s-1", "lote_codigo": "L1"}
+
+    r = c.post("/scans/stream", params=params, content=_ndjson(6, mala=5))
+    assert r.status_code == 400
+    assert ledger["s-1"]["estado"] == "ERROR"
+    assert ledger["s-1"]["lineas"] == 4
+    assert ledger["s-1"]["accepted_count"] == 4
+
+    r = c.post("/scans/stream", params=params, content=_ndjson(6))
+    assert r.status_code == 200
+    body = r.json()
+    assert body["resumed_from_line"] == 4
+    assert body["accepted_count"] == 6
+    assert body["duplicate_count"] == 0
+    assert body["lines"] == 6
+    assert insertados == [f"T{i}" for i in range(1, 7)]
@@ -839,6 +839,11 @@ def generar_vista_previa():
 
     valor_visible = trabajador["num_orden"] if opcion == "Número de orden" else trabajador["cod_letra"]
 
+    # Revalidación con ETag: si la imagen no cambió, el servidor responde 304 sin cuerpo
+    headers = {}
+    if st.session_state.get("preview_img") and st.session_state.get("preview_etag"):
+        headers["If-None-Match"] = st.session_state.preview_etag
+
     try:
         r = requests.post(
             f"{API}/qr/preview",
@@ -848,6 +853,7 @@ def generar_vista_previa():
                 "producto": producto,
                 "cantidad": cantidad
             },
+            headers=headers,
             timeout=10
         )
     except Exception as e:
@@ -855,8 +861,11 @@ def generar_vista_previa():
         st.session_state.preview_error = str(e)
         return
 
-    if r.status_code == 200 and "image" in (r.headers.get("content-type") or ""):
+    if r.status_code == 304:
+        st.session_state.preview_error = None
+    elif r.status_code == 200 and "image" in (r.headers.get("content-type") or ""):
         st.session_state.preview_img = r.content
+        st.session_state.preview_etag = r.headers.get("etag")
         st.session_state.preview_error = None
     else:
         st.session_state.preview_img = None
@@ -1002,11 +1011,29 @@ if "🖨️ Impresión" in tabs:
                             st.stop()
 
                         if r_print.status_code == 200:
-                            st.toast("Impresión enviada correctamente 🖨️", icon="✅")
+                            run_id = r_print.json().get("run_id")
+                            st.session_state.ultima_corrida = run_id
+                            st.toast("Impresión encolada correctamente 🖨️", icon="✅")
                         else:
                             st.error("Error al imprimir")
                             st.code(r_print.text)
 
+                    ultima_corrida = st.session_state.get("ultima_corrida")
+                    if ultima_corrida:
+                        try:
+                            r_run = requests.get(f"{API}/qr/runs/{ultima_corrida}", timeout=5)
+                            if r_run.status_code == 200:
+                                run = r_run.json()
+                                total = run.get("filas_total") or 0
+                                hechas = (run.get("filas_enviadas") or 0) + (run.get("filas_fallidas") or 0)
+                                st.progress(
+                                    hechas / total if total else 1.0,
+                                    text=f"Corrida {ultima_corrida[:8]}: {run.get('estado')} "
+                                         f"({run.get('filas_enviadas')}/{total} filas, {run.get('filas_fallidas')} con error)"
+                                )
+                        except Exception:
+                            pass
+
 # ======================================================
 # TAB: IMPRESORAS
 # ======================================================